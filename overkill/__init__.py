@@ -1 +1,14 @@
-__import__('pkg_resources').declare_namespace(__name__)
+# A pkgutil-style namespace package, without the cost of importing pkgutil
+# (or pkg_resources) on every start.
+def _extend_path(path, name):
+    import os, sys
+    subdir = os.path.join(*name.split("."))
+    for entry in sys.path:
+        if not isinstance(entry, str):
+            continue
+        candidate = os.path.abspath(os.path.join(entry, subdir))
+        if candidate not in path and os.path.isdir(candidate):
+            path.append(candidate)
+    return path
+
+__path__ = _extend_path(__path__, __name__)
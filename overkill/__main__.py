@@ -15,5 +15,5 @@
 #    along with Overkill.  If not, see <http://www.gnu.org/licenses/>.
 ##
 
-from daemon import run
+from overkill.daemon import run
 run()
@@ -20,7 +20,7 @@ from threading import Lock
 from .exceptions import NotPublishingError, NoSourceError
 import subprocess
 import os
-from time import time
+from time import monotonic
 
 __all__ = ("Runnable", "Subscriber", "Publisher")
 
@@ -57,9 +57,20 @@ class Runnable:
 
 
 class Subscriber:
+    # Allow the manager to merge pending updates (see Manager.coalesce).
+    coalesce_updates = True
+    # Handle at most max_rate batches of updates per second and/or only once
+    # no updates arrived for debounce seconds. Updates arriving in between
+    # are merged and handled together when the timer fires.
+    max_rate = None
+    debounce = None
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.subscriptions = {}
+        self._throttled = {}
+        self._throttle_timer = None
+        self._last_handled = float("-inf")
 
     def subscribe_to(self, subscription, source=None):
         if source is None:
@@ -81,9 +92,56 @@ class Subscriber:
             del self.subscriptions[subscription]
         source.unsubscribe(self, subscription)
 
-    @manager.queued
+    # Pending updates from the same source are merged (last write wins)
+    # when the manager is coalescing.
+    @manager.queued(
+        key=lambda self, updates, source:
+            (self, source) if self.coalesce_updates else None,
+        merge=lambda old, new: (old[0], {**old[1], **new[1]}, old[2])
+    )
     def receive_updates(self, updates, source):
-        self.handle_updates(updates, source)
+        if self.max_rate is None and self.debounce is None:
+            self.handle_updates(updates, source)
+        else:
+            self._throttle_updates(updates, source)
+
+    def _throttle_updates(self, updates, source):
+        from .sources import get_timersource
+        try:
+            self._throttled[source].update(updates)
+        except KeyError:
+            self._throttled[source] = dict(updates)
+
+        delay = self.debounce or 0
+        if self.max_rate:
+            delay = max(delay, self._last_handled + 1/self.max_rate - monotonic())
+
+        if self._throttle_timer is not None:
+            # Restart the debounce window (unless the timer just fired).
+            if self.debounce is None or self._throttle_timer.reschedule(delay):
+                return
+        elif delay <= 0:
+            self._handle_throttled()
+            return
+        self._throttle_timer = get_timersource().call_later(
+            delay, Subscriber._handle_throttled, self
+        )
+
+    def _cancel_throttled(self):
+        """ Forget updates held back by max_rate or debounce """
+        if self._throttle_timer is not None:
+            self._throttle_timer.cancel()
+            self._throttle_timer = None
+        self._throttled = {}
+
+    def _handle_throttled(self):
+        self._throttle_timer = None
+        if not self._throttled:
+            return
+        self._last_handled = monotonic()
+        throttled, self._throttled = self._throttled, {}
+        for source, updates in throttled.items():
+            self.handle_updates(updates, source)
 
     def handle_updates(self, updates, source):
         raise NotImplementedError()
@@ -105,15 +163,60 @@ class Subscriber:
 
 class Publisher:
     publishes = []
+    # Types of the subscriptions this publisher may accept (None for any).
+    # Lets an Aggregator route subscriptions without asking every publisher.
+    subscription_types = None
+    # Don't publish values that are unchanged (see is_unchanged): True for
+    # every subscription or a collection of the subscriptions to filter.
+    suppress_unchanged = False
+    # Save published values across restarts when the manager has a state
+    # store (see Manager.enable_state). Publishers with more than one
+    # instance need distinct state_keys.
+    persist_state = False
+    _restored = False
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.subscribers = {}
         self.published_data = {}
+        # Restored values that haven't been published again yet.
+        self._stale = set()
+        # Immutable snapshot of self.subscribers used when publishing.
+        # Equal subscriber sets are shared so multi-key updates can usually
+        # skip building a union.
+        self._fanout = {}
+        self._fanout_cache = {}
+
+    def _reindex(self, subscription):
+        subscribers = self.subscribers.get(subscription)
+        if subscribers:
+            subscribers = frozenset(subscribers)
+            for other in self._fanout.values():
+                if other == subscribers:
+                    subscribers = other
+                    break
+            self._fanout[subscription] = subscribers
+        else:
+            self._fanout.pop(subscription, None)
+        self._fanout_cache = {}
 
     def get(self, *args, **kwargs):
         return self.published_data.get(*args, **kwargs)
 
+    @property
+    def state_key(self):
+        """
+        Identifies this publisher's saved values across restarts. Override
+        when there's more than one instance of a class: only the first
+        instance with a key restores and saves values under it.
+        """
+        cls = type(self)
+        return "%s.%s" % (cls.__module__, cls.__qualname__)
+
+    def is_stale(self, subscription):
+        """ Whether the value of subscription was restored from a previous run """
+        return subscription in self._stale
+
     def is_publishing(self, subscription):
         return self._can_publish() and subscription in self.publishes
 
@@ -125,6 +228,9 @@ class Publisher:
         if not self.is_publishing(subscription):
             raise NotPublishingError(self, subscription, subscriber)
         self.subscribers.setdefault(subscription, set()).add(subscriber)
+        self._reindex(subscription)
+        if manager.state is not None and self.persist_state:
+            manager.state.restore(self)
         if subscription in self.published_data:
             subscriber.receive_updates(self.published_data, self)
         self.on_subscribe(subscriber, subscription)
@@ -141,70 +247,190 @@ class Publisher:
             self.subscribers[subscription].remove(subscriber)
             if not self.subscribers[subscription]:
                 del self.subscribers[subscription]
-            self.on_unsubscribe(subscriber, subscription)
         except KeyError:
-            pass
+            return
+        self._reindex(subscription)
+        self.on_unsubscribe(subscriber, subscription)
 
     def push_unsubscribe(self, subscription):
         try:
             subscribers = self.subscribers.pop(subscription)
         except KeyError:
             return
+        self._reindex(subscription)
         for sink in subscribers:
             sink.receive_unsubscribe(subscription, self)
 
     def is_subscribed(self, subscription):
         return subscription in self.subscribers
 
+    def is_unchanged(self, subscription, old, new):
+        return old == new
+
+    def _drop_unchanged(self, updates):
+        suppress = self.suppress_unchanged
+        published = self.published_data
+        changed = updates
+        for key, value in updates.items():
+            if (suppress is True or key in suppress) \
+                    and key in published \
+                    and self.is_unchanged(key, published[key], value):
+                if changed is updates:
+                    changed = dict(updates)
+                del changed[key]
+        return changed
+
     def push_updates(self, updates):
+        if self._stale:
+            # Published again, even if unchanged.
+            self._stale.difference_update(updates)
+        if self.suppress_unchanged:
+            updates = self._drop_unchanged(updates)
+            if not updates:
+                return
         self.published_data.update(updates)
-        for subscriber in set().union(
-            *(self.subscribers[k] for k in updates if k in self.subscribers)
-        ):
+        if manager.metrics is not None:
+            manager.metrics.count_events(self, updates)
+        if manager.state is not None and self.persist_state:
+            manager.state.record(self, updates)
+        if len(updates) == 1:
+            for key in updates:
+                subscribers = self._fanout.get(key, ())
+        else:
+            subscribers = self._subscribers_of(updates)
+        for subscriber in subscribers:
             subscriber.receive_updates(updates, self)
 
+    def _subscribers_of(self, updates):
+        fanout = self._fanout
+        found = None
+        for key in updates:
+            subscribers = fanout.get(key)
+            if subscribers is None or subscribers is found:
+                continue
+            if found is None:
+                found = subscribers
+                continue
+            # Keys with different subscribers; use (and cache) the union.
+            keys = frozenset(updates)
+            cache = self._fanout_cache
+            try:
+                return cache[keys]
+            except KeyError:
+                pass
+            if len(cache) >= 256:
+                cache.clear()
+            union = cache[keys] = frozenset().union(
+                *(fanout[k] for k in keys if k in fanout)
+            )
+            return union
+        return found or ()
+
 
 class Subprocess(Runnable):
     cmd = None
     proc = None
-    restart = False
+    # Restart the process whenever it exits while running. Restarts back
+    # off exponentially from restart_delay up to max_restart_delay seconds;
+    # after max_restarts restarts in a row of processes that lived for less
+    # than start_limit_interval seconds, stop instead. (Older configurations
+    # set restart = True instead; that's still honoured.)
+    restart_on_exit = False
+    restart_delay = 0.1
+    max_restart_delay = 30
     max_restarts = 5
     start_limit_interval = 10
+    # Spawn through posix_spawn() (vfork) instead of fork() and exec():
+    # inherited file descriptors aren't closed one by one (Python's are
+    # close-on-exec anyway) and cmd[0] is looked up on the PATH up front.
+    fast_spawn = False
 
     stdout = stderr = open(os.devnull, 'wb')
     stdin = None
 
+    _fast_cmd = None
+    _restart_timer = None
+
     def start(self):
         if super().start():
             self._restarts = 0
-            self._last_restart = time()//1000
+            self._restart_now = False
+            self._gave_up = False
             return self._start_subprocess()
         return False
 
-    def _maybe_restart(self):
-        if self.running and self.restart:
-            now = time()//1000
-            self._restarts -= min(
-                (self._restarts//self.start_limit_interval)*(now - self._last_restart),
-                self._restarts
-            )
-            self._last_restart = now
-            if (self._restarts//self.start_limit_interval) < self.max_restarts:
-                self._restarts += self.start_limit_interval
-                return self._start_subprocess()
-        return False
+    def _spawn(self):
+        kwargs = {}
+        cmd = self.cmd
+        if self.fast_spawn:
+            if self._fast_cmd is None or self._fast_cmd[0] is not cmd:
+                import shutil
+                resolved = [cmd] if isinstance(cmd, str) else list(cmd)
+                resolved[0] = shutil.which(resolved[0]) or resolved[0]
+                self._fast_cmd = (cmd, resolved)
+            cmd = self._fast_cmd[1]
+            kwargs["close_fds"] = False
+        return subprocess.Popen(cmd, stderr=self.stderr, stdout=self.stdout, stdin=self.stdin, **kwargs)
 
     def _start_subprocess(self):
+        from .sources import get_childsource
         with self._state_lock:
             try:
                 if not (self.proc and self.proc.poll() is None):
-                    self.proc = subprocess.Popen(self.cmd, stderr=self.stderr, stdout=self.stdout, stdin=self.stdin)
+                    started = monotonic()
+                    self.proc = self._spawn()
+                    self._started = monotonic()
+                    if manager.metrics is not None:
+                        manager.metrics.record_spawn(self, self._started - started)
+                    get_childsource().watch(self.proc, Subprocess._child_exited, self, self.proc)
             except:
                 return False
             return True
 
+    def _child_exited(self, proc):
+        from .sources import get_timersource
+        if proc is not self.proc or not self.running:
+            return
+        if self._restart_now:
+            self._restart_now = False
+            self._start_subprocess()
+            return
+        if not self._restarts_on_exit() or self._gave_up:
+            return
+        if monotonic() - self._started >= self.start_limit_interval:
+            self._restarts = 0
+        if self._restarts >= self.max_restarts:
+            self._give_up()
+            return
+        delay = min(self.restart_delay * 2**self._restarts, self.max_restart_delay)
+        self._restarts += 1
+        if manager.metrics is not None:
+            manager.metrics.count_restart(self)
+        self._restart_timer = get_timersource().call_later(
+            delay, Subprocess._restart_timer_fired, self
+        )
+
+    def _restarts_on_exit(self):
+        # A restart attribute shadowing the restart() method is the old flag.
+        restart = self.restart
+        if not callable(restart):
+            return bool(restart)
+        return self.restart_on_exit
+
+    def _give_up(self):
+        self._gave_up = True
+        self.stop()
+
+    def _restart_timer_fired(self):
+        self._restart_timer = None
+        if self.running:
+            self._start_subprocess()
+
     def stop(self):
         if super().stop():
+            if self._restart_timer is not None:
+                self._restart_timer.cancel()
+                self._restart_timer = None
             try:
                 self.proc.terminate()
             except:
@@ -215,10 +441,17 @@ class Subprocess(Runnable):
     def restart(self):
         if not self.running:
             return
-        try:
-            self.proc.termintate()
-        except:
-            pass
+        if self.proc and self.proc.poll() is None:
+            # Started again as soon as it has exited.
+            self._restart_now = True
+            try:
+                self.proc.terminate()
+            except:
+                pass
+            return
+        if self._restart_timer is not None:
+            self._restart_timer.cancel()
+            self._restart_timer = None
         self._start_subprocess()
 
     def wait(self):
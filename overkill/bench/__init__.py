@@ -0,0 +1,76 @@
+##
+#    This file is part of Overkill.
+#
+#    Overkill is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Overkill is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Overkill.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""
+Benchmarks for the pub-sub core.
+
+Each benchmark module has a run(duration) function returning plain data;
+python -m overkill.bench runs them all and prints the results as JSON.
+"""
+
+import threading
+import time
+
+__all__ = ("run_manager", "wait_for", "summarize", "BENCHMARKS")
+
+BENCHMARKS = ("fanout", "pubsub", "aggregator", "fd", "timer", "inotify")
+
+
+def run_manager(workload, timeout=60):
+    """
+    Run the manager on this (the main) thread while workload() runs on
+    another one; stop the manager once it returns and return its result.
+    """
+    from overkill import manager
+    result = {}
+    def target():
+        try:
+            result["value"] = workload()
+        except BaseException as e:
+            result["error"] = e
+        finally:
+            manager.stop()
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    manager.run()
+    thread.join(timeout)
+    if "error" in result:
+        raise result["error"]
+    return result.get("value")
+
+
+def wait_for(predicate, timeout=10, interval=0.001):
+    end = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > end:
+            raise TimeoutError("benchmark stalled")
+        time.sleep(interval)
+
+
+def summarize(latencies):
+    """ Summarize a list of latencies (seconds) """
+    if not latencies:
+        return {"count": 0}
+    latencies = sorted(latencies)
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies)*p))]
+    return {
+        "count": len(latencies),
+        "p50": percentile(0.5),
+        "p99": percentile(0.99),
+        "max": latencies[-1],
+    }
@@ -0,0 +1,54 @@
+##
+#    This file is part of Overkill.
+#
+#    Overkill is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Overkill is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Overkill.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+import argparse
+import importlib
+import json
+import platform
+import sys
+import traceback
+from . import BENCHMARKS
+
+parser = argparse.ArgumentParser(
+    prog="python -m overkill.bench",
+    description="Benchmark the overkill pub-sub core and print JSON results."
+)
+parser.add_argument("benchmarks", nargs="*", metavar="BENCHMARK",
+                    help="benchmarks to run: %s (default: all)" % ", ".join(BENCHMARKS))
+parser.add_argument("-d", "--duration", type=float, default=1.0,
+                    help="seconds to run each measurement for")
+args = parser.parse_args()
+for name in args.benchmarks:
+    if name not in BENCHMARKS:
+        parser.error("unknown benchmark: %s" % name)
+
+results = {}
+for name in args.benchmarks or BENCHMARKS:
+    try:
+        module = importlib.import_module("overkill.bench." + name)
+        results[name] = module.run(args.duration)
+    except Exception as e:
+        traceback.print_exc()
+        results[name] = {"error": "%s: %s" % (type(e).__name__, e)}
+
+json.dump({
+    "python": platform.python_version(),
+    "platform": platform.platform(),
+    "duration": args.duration,
+    "results": results,
+}, sys.stdout, indent=2, sort_keys=True)
+sys.stdout.write("\n")
@@ -0,0 +1,71 @@
+##
+#    This file is part of Overkill.
+#
+#    Overkill is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Overkill is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Overkill.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""
+Subscribing through (and publishing via) the Aggregator with many sources.
+"""
+
+import time
+import tracemalloc
+from overkill import manager
+from overkill.sources import Source
+from .pubsub import LatencySubscriber, throughput
+from . import run_manager, wait_for
+
+__all__ = ("run",)
+
+
+class KeySource(Source):
+    def __init__(self, key):
+        super().__init__()
+        self.publishes = [key]
+
+
+def run(duration=1.0, sources=200, subscribers=1000):
+    all_sources = [KeySource("key-%d" % i) for i in range(sources)]
+    for source in all_sources:
+        manager.add_source(source)
+    aggregator = manager.aggregator
+
+    def workload():
+        subs = [LatencySubscriber() for _ in range(subscribers)]
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        start = time.perf_counter()
+        for i, subscriber in enumerate(subs):
+            subscriber.subscribe_to("key-%d" % (i % sources))
+        wait_for(lambda: sum(len(s) for s in aggregator.subscribers.values()) == subscribers)
+        elapsed = time.perf_counter() - start
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        allocated = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+
+        # Publish through the aggregator from one source to its subscribers.
+        fanout = [s for i, s in enumerate(subs) if i % sources == 0]
+        return {
+            "sources": sources,
+            "subscriptions": subscribers,
+            "subscribe_per_sec": subscribers/elapsed,
+            "bytes_per_subscription": allocated/subscribers,
+            "throughput": throughput(all_sources[0], fanout, duration, key="key-0"),
+        }
+
+    try:
+        return run_manager(workload)
+    finally:
+        aggregator.sources[:] = [s for s in aggregator.sources if s not in all_sources]
+        aggregator.invalidate_routes()
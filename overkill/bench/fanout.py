@@ -0,0 +1,82 @@
+##
+#    This file is part of Overkill.
+#
+#    Overkill is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Overkill is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Overkill.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+
+"""
+Micro-benchmark for Publisher.push_updates fan-out.
+
+Subscribers count deliveries directly (nothing is queued) so only the cost
+of publishing is measured. Run with: python -m overkill.bench.fanout
+"""
+
+import json
+import time
+from overkill.base import Publisher, Subscriber
+
+__all__ = ("run",)
+
+
+class CountingSubscriber(Subscriber):
+    def __init__(self):
+        super().__init__()
+        self.received = 0
+
+    def receive_updates(self, updates, source):
+        self.received += 1
+
+
+def _publisher(keys, subscribers):
+    publisher = Publisher()
+    publisher.publishes = keys
+    for _ in range(subscribers):
+        subscriber = CountingSubscriber()
+        for key in keys:
+            # Subscribe directly instead of going through the queue.
+            Publisher.subscribe.__wrapped__(publisher, subscriber, key)
+    return publisher
+
+
+def bench(keys, subscribers, updated, duration=1.0):
+    publisher = _publisher(keys, subscribers)
+    updates = [{key: i for key in keys[:updated]} for i in range(64)]
+    push = publisher.push_updates
+    events = 0
+    end = time.perf_counter() + duration
+    while time.perf_counter() < end:
+        for update in updates:
+            push(update)
+        events += len(updates)
+    return events / duration
+
+
+SCENARIOS = {
+    "1key-1sub": (["a"], 1, 1),
+    "1key-10subs": (["a"], 10, 1),
+    "3keys-10subs-1updated": (["a", "b", "c"], 10, 1),
+    "3keys-10subs-3updated": (["a", "b", "c"], 10, 3),
+}
+
+
+def run(duration=1.0):
+    return {
+        name: {"events_per_sec": round(bench(*args, duration=duration))}
+        for name, args in SCENARIOS.items()
+    }
+
+
+if __name__ == "__main__":
+    print(json.dumps(run(), indent=2))
@@ -0,0 +1,96 @@
+##
+#    This file is part of Overkill.
+#
+#    Overkill is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Overkill is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Overkill.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""
+Lines written to pipes, read and published by the FDManagerSource.
+"""
+
+import os
+import time
+from overkill.sources import Lines, get_fdsource
+from overkill.base import Subscriber
+from . import run_manager, wait_for, summarize
+
+__all__ = ("run",)
+
+
+class LineSubscriber(Subscriber):
+    coalesce_updates = False
+
+    def __init__(self, f):
+        super().__init__()
+        self.f = f
+        self.key = Lines(f)
+        self.lines = 0
+        self.latencies = []
+
+    def handle_updates(self, updates, source):
+        now = time.perf_counter()
+        lines = updates.get(self.key, ())
+        self.lines += len(lines)
+        for line in lines:
+            if line:
+                self.latencies.append(now - float(line))
+
+
+def run(duration=1.0, pipes=4, rate=1000):
+    source = get_fdsource()
+    ends = [os.pipe() for _ in range(pipes)]
+    files = [os.fdopen(r, "rb") for r, _ in ends]
+    subscribers = [LineSubscriber(f) for f in files]
+
+    def workload():
+        for subscriber in subscribers:
+            subscriber.subscribe_to(subscriber.key, source)
+        wait_for(lambda: all(s.key in source.subscribers for s in subscribers))
+
+        # Throughput: fill the pipes with (timestamp-free) lines.
+        chunk = b"\n"*4096
+        written = 0
+        start = time.perf_counter()
+        end = start + duration
+        while time.perf_counter() < end:
+            for _, w in ends:
+                os.write(w, chunk)
+            written += len(chunk)*pipes
+            # Don't outrun the reader by more than the pipe buffer.
+            wait_for(lambda: sum(s.lines for s in subscribers) >= written - 65536*pipes)
+        wait_for(lambda: sum(s.lines for s in subscribers) >= written)
+        lines_per_sec = written/(time.perf_counter() - start)
+
+        # Latency: one timestamped line per pipe at a fixed rate.
+        count = int(duration*rate)
+        for _ in range(count):
+            for _, w in ends:
+                os.write(w, b"%r\n" % time.perf_counter())
+            time.sleep(1/rate)
+        wait_for(lambda: all(len(s.latencies) >= count for s in subscribers))
+
+        for subscriber in subscribers:
+            subscriber.unsubscribe_from(subscriber.key, source)
+        return {
+            "pipes": pipes,
+            "lines_per_sec": lines_per_sec,
+            "latency": summarize([l for s in subscribers for l in s.latencies]),
+        }
+
+    try:
+        return run_manager(workload)
+    finally:
+        for (_, w), f in zip(ends, files):
+            os.close(w)
+            f.close()
@@ -0,0 +1,72 @@
+##
+#    This file is part of Overkill.
+#
+#    Overkill is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Overkill is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Overkill.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""
+File creation events from the FWManagerSource (in a temporary directory).
+"""
+
+import os
+import tempfile
+import time
+from overkill.inotify import IN_CREATE
+from overkill.sources import get_fwsource
+from overkill.sinks import InotifySink
+from . import run_manager, wait_for, summarize
+
+__all__ = ("run",)
+
+
+class CreateSink(InotifySink):
+    def __init__(self, path):
+        super().__init__()
+        self.watches = [{"path": path, "mask": IN_CREATE}]
+        self.created = {}
+        self.latencies = []
+
+    def file_changed(self, event):
+        now = time.perf_counter()
+        try:
+            self.latencies.append(now - self.created.pop(event.pathname))
+        except KeyError:
+            pass
+
+
+def run(duration=1.0, files=2000):
+    with tempfile.TemporaryDirectory() as path:
+        sink = CreateSink(path)
+        source = get_fwsource()
+
+        def workload():
+            sink.start()
+            wait_for(lambda: source.subscribers)
+            start = time.perf_counter()
+            end = start + duration
+            created = 0
+            while created < files and time.perf_counter() < end:
+                name = os.path.join(path, str(created))
+                sink.created[name] = time.perf_counter()
+                open(name, "w").close()
+                created += 1
+            wait_for(lambda: len(sink.latencies) >= created)
+            elapsed = time.perf_counter() - start
+            sink.stop()
+            return {
+                "events_per_sec": created/elapsed,
+                "latency": summarize(sink.latencies),
+            }
+
+        return run_manager(workload)
@@ -0,0 +1,94 @@
+##
+#    This file is part of Overkill.
+#
+#    Overkill is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Overkill is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Overkill.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""
+Publisher -> Subscriber delivery through the real manager queue.
+"""
+
+import time
+from overkill.base import Publisher, Subscriber
+from . import run_manager, wait_for, summarize
+
+__all__ = ("run",)
+
+
+class LatencySubscriber(Subscriber):
+    """ Records the delay between publishing (the value) and handling """
+    def __init__(self):
+        super().__init__()
+        self.latencies = []
+
+    def handle_updates(self, updates, source):
+        now = time.perf_counter()
+        for value in updates.values():
+            self.latencies.append(now - value)
+
+    def handle_unsubscribe(self, subscription, source):
+        # Publishers unsubscribe everyone when they stop.
+        pass
+
+
+def _subscribed(publisher, count, key="value"):
+    subscribers = [LatencySubscriber() for _ in range(count)]
+    for subscriber in subscribers:
+        subscriber.subscribe_to(key, publisher)
+    wait_for(lambda: len(publisher.subscribers.get(key, ())) == count)
+    return subscribers
+
+
+def throughput(publisher, subscribers, duration, key="value"):
+    """ Publish as fast as possible; returns delivered updates/sec """
+    for subscriber in subscribers:
+        subscriber.latencies.clear()
+    published = 0
+    start = time.perf_counter()
+    end = start + duration
+    while time.perf_counter() < end:
+        for _ in range(100):
+            publisher.push_updates({key: time.perf_counter()})
+        published += 100
+    expected = published*len(subscribers)
+    wait_for(lambda: sum(len(s.latencies) for s in subscribers) >= expected, timeout=60)
+    return {
+        "published_per_sec": published/duration,
+        "delivered_per_sec": expected/(time.perf_counter() - start),
+    }
+
+
+def latency(publisher, subscribers, duration, rate=1000, key="value"):
+    """ Publish at a fixed rate; returns end-to-end latency percentiles """
+    for subscriber in subscribers:
+        subscriber.latencies.clear()
+    count = int(duration*rate)
+    for _ in range(count):
+        publisher.push_updates({key: time.perf_counter()})
+        time.sleep(1/rate)
+    wait_for(lambda: all(len(s.latencies) >= count for s in subscribers))
+    return summarize([l for s in subscribers for l in s.latencies])
+
+
+def run(duration=1.0, subscribers=10):
+    publisher = Publisher()
+    publisher.publishes = ["value"]
+    def workload():
+        subs = _subscribed(publisher, subscribers)
+        return {
+            "subscribers": subscribers,
+            "throughput": throughput(publisher, subs, duration),
+            "latency": latency(publisher, subs, duration),
+        }
+    return run_manager(workload)
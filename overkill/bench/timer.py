@@ -0,0 +1,71 @@
+##
+#    This file is part of Overkill.
+#
+#    Overkill is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Overkill is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Overkill.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""
+Timer wakeups for many subscribers with loose, overlapping intervals.
+"""
+
+import random
+import time
+from overkill.sources import TimerSource
+from overkill.base import Subscriber
+from . import run_manager
+
+__all__ = ("run",)
+
+
+class CountingTimerSource(TimerSource):
+    """ Counts the wakeups that fired at least one timer """
+    wakeups = 0
+
+    def push_updates(self, updates):
+        self.wakeups += 1
+        super().push_updates(updates)
+
+
+class TickSubscriber(Subscriber):
+    ticks = 0
+
+    def handle_updates(self, updates, source):
+        self.ticks += 1
+
+
+def run(duration=1.0, timers=200, seed=0):
+    source = CountingTimerSource()
+    rng = random.Random(seed)
+    # Intervals between 50ms and 200ms with up to 100% slack.
+    intervals = set()
+    while len(intervals) < timers:
+        early = rng.randint(50, 200)/1000
+        intervals.add((early, early*(1 + rng.random())))
+    subscribers = [TickSubscriber() for _ in intervals]
+
+    def workload():
+        for subscriber, interval in zip(subscribers, intervals):
+            subscriber.subscribe_to(interval, source)
+        time.sleep(duration)
+        wakeups = source.wakeups
+        ticks = sum(s.ticks for s in subscribers)
+        for subscriber, interval in zip(subscribers, intervals):
+            subscriber.unsubscribe_from(interval, source)
+        return {
+            "timers": timers,
+            "wakeups_per_sec": wakeups/duration,
+            "ticks_per_sec": ticks/duration,
+        }
+
+    return run_manager(workload)
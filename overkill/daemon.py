@@ -15,17 +15,109 @@
 #    along with Overkill.  If not, see <http://www.gnu.org/licenses/>.
 ##
 
+"""
+Runs the configuration in ~/.config/overkill/*.py.
+
+Compiled configuration files are cached in ~/.cache/overkill (keyed on the
+file's mtime and size). `overkill --startup-times` reports how long each
+step of starting up took.
+"""
+
 from . import manager
+from .util import xdg_home
+import os
+import sys
+import time
+
+__all__=("run", "load_config")
+
+_header_size = 16
+
+def _cache_path(cache_dir, path):
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(cache_dir, "%s.%s.pyc" % (name, sys.implementation.cache_tag))
 
-__all__=("run",)
+def load_config(path, cache_dir=None):
+    """
+    Compile the config file at path. With a cache_dir, the code object
+    cached there is used while the file's mtime and size are unchanged.
+    Returns (code, whether it came from the cache).
+    """
+    import marshal
+    st = os.stat(path)
+    header = st.st_mtime_ns.to_bytes(8, "little") + st.st_size.to_bytes(8, "little")
+    cache = cache_dir and _cache_path(cache_dir, path)
+    if cache:
+        try:
+            with open(cache, "rb") as f:
+                data = f.read()
+            if data[:_header_size] == header:
+                return marshal.loads(data[_header_size:]), True
+        except (OSError, ValueError, EOFError, TypeError):
+            pass
 
-def run():
-    import os.path
+    with open(path, "rb") as f:
+        code = compile(f.read(), path, "exec")
+
+    if cache:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp = "%s.%d" % (cache, os.getpid())
+            with open(tmp, "wb") as f:
+                f.write(header + marshal.dumps(code))
+            os.replace(tmp, cache)
+        except OSError:
+            # Just don't cache (e.g. a read-only home).
+            pass
+    return code, False
+
+def _parse_args(argv):
+    if not argv:
+        # Don't pay for argparse on a normal start.
+        return None
+    import argparse
+    parser = argparse.ArgumentParser(
+        prog="overkill",
+        description="Run the overkill configuration in $XDG_CONFIG_HOME/overkill."
+    )
+    parser.add_argument(
+        "--startup-times", action="store_true",
+        help="print how long loading and starting the configuration took to stderr"
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true",
+        help="don't use (or update) the compiled configuration cache"
+    )
+    return parser.parse_args(argv)
+
+def _report(steps, started):
+    steps.append(("start sinks", time.perf_counter() - started))
+    width = max(len(name) for name, _ in steps)
+    for name, seconds in steps:
+        print("%-*s %8.2fms" % (width, name, seconds*1000), file=sys.stderr)
+    print("%-*s %8.2fms" % (width, "total", sum(s for _, s in steps)*1000), file=sys.stderr)
+
+def run(argv=None):
     from glob import glob
-    from xdg.BaseDirectory import xdg_config_home
 
-    for fp in glob(os.path.join(xdg_config_home, "overkill/*.py")):
-        with open(fp) as f:
-            exec(f.read(), {})
+    args = _parse_args(sys.argv[1:] if argv is None else argv)
+    report = args is not None and args.startup_times
+    cache_dir = None
+    if args is None or not args.no_cache:
+        cache_dir = os.path.join(xdg_home("XDG_CACHE_HOME", ".cache"), "overkill")
+
+    steps = []
+    config_dir = os.path.join(xdg_home("XDG_CONFIG_HOME", ".config"), "overkill")
+    for fp in glob(os.path.join(config_dir, "*.py")):
+        name = os.path.basename(fp)
+        started = time.perf_counter()
+        code, cached = load_config(fp, cache_dir)
+        loaded = time.perf_counter()
+        exec(code, {"__file__": fp})
+        steps.append(("%s (%s)" % (name, "cached" if cached else "compile"), loaded - started))
+        steps.append(("%s (run)" % name, time.perf_counter() - loaded))
 
+    if report:
+        # The first queued call runs once the sinks have been started.
+        manager.queue(_report, (steps, time.perf_counter()))
     manager.run()
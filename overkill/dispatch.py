@@ -0,0 +1,318 @@
+##
+#    This file is part of Overkill.
+#
+#    Overkill is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Overkill is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Overkill.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+import queue
+import threading
+from collections import deque
+
+__all__ = ("Dispatcher", "PoolDispatcher", "AsyncioDispatcher")
+
+def _finish_tasks(loop):
+    """ Cancel what's left on a stopped loop and let it clean up """
+    import asyncio
+    # Deliver cancellations requested from other threads first.
+    loop.run_until_complete(asyncio.sleep(0))
+    tasks = asyncio.all_tasks(loop)
+    if tasks:
+        for task in tasks:
+            # Don't interrupt the cleanup of coroutines already cancelled
+            # (Task.cancelling() is new in Python 3.11).
+            if not getattr(task, "cancelling", lambda: 0)():
+                task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+    loop.run_until_complete(loop.shutdown_asyncgens())
+
+
+class Dispatcher:
+    """ Runs every task on the thread that calls run() """
+    # How long close() waits for each spawned coroutine's thread.
+    join_timeout = 5
+
+    def __init__(self, handle):
+        self.handle = handle
+        self._queue = queue.Queue()
+        self._owner = None
+        self._spawned = {}
+
+    def put(self, task):
+        self._queue.put(task)
+
+    def qsize(self):
+        return self._queue.qsize()
+
+    def is_dispatch_thread(self):
+        return threading.get_ident() == self._owner
+
+    def drop_oldest(self, droppable):
+        """
+        Remove and return the oldest queued task for which droppable(task)
+        is true (None if there is none)
+        """
+        return self._drop_oldest(self._queue, droppable)
+
+    @staticmethod
+    def _drop_oldest(q, droppable):
+        with q.mutex:
+            for i, task in enumerate(q.queue):
+                # None shuts down a worker.
+                if task is not None and droppable(task):
+                    del q.queue[i]
+                    q.not_full.notify()
+                    return task
+            return None
+
+    def drain(self):
+        tasks = []
+        while True:
+            try:
+                tasks.append(self._queue.get_nowait())
+            except queue.Empty:
+                return tasks
+
+    def run(self):
+        self._owner = threading.get_ident()
+        while True:
+            self.handle(self._queue.get())
+
+    def flush(self):
+        while True:
+            try:
+                task = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            self.handle(task)
+
+    def spawn(self, coro):
+        """ Run a coroutine on a private event loop in its own thread """
+        import asyncio
+        loop = asyncio.new_event_loop()
+        def run():
+            try:
+                loop.run_forever()
+                # A cancelled coroutine hasn't seen its CancelledError yet.
+                _finish_tasks(loop)
+            finally:
+                loop.close()
+                self._spawned.pop(threading.current_thread(), None)
+        thread = threading.Thread(target=run, daemon=True)
+        future = asyncio.run_coroutine_threadsafe(coro, loop)
+        future.add_done_callback(lambda f: loop.call_soon_threadsafe(loop.stop))
+        self._spawned[thread] = future
+        thread.start()
+        return future
+
+    def close(self):
+        """ Called once the manager has shut down """
+        for thread, future in list(self._spawned.items()):
+            future.cancel()
+            # Don't let a wedged coroutine block shutdown forever.
+            thread.join(self.join_timeout)
+            self._spawned.pop(thread, None)
+        self.flush()
+
+
+class PoolDispatcher(Dispatcher):
+    """
+    Runs tasks on a pool of worker threads.
+
+    Tasks are sharded by their target (the object a queued method is called
+    on) so every object still sees its calls in order while unrelated objects
+    are handled in parallel.
+    """
+    join_timeout = 5
+
+    def __init__(self, handle, workers):
+        self.handle = handle
+        self._spawned = {}
+        self._queues = [queue.Queue() for _ in range(workers)]
+        self._threads = []
+        self._done = threading.Event()
+        self._owner = None
+        self._workers = set()
+
+    def _shard(self, task):
+        fn, args = task[0], task[1]
+        target = args[0] if args else getattr(fn, "__self__", None)
+        # Object ids are aligned; drop the low bits before sharding.
+        return (id(target) >> 4) % len(self._queues)
+
+    def put(self, task):
+        self._queues[self._shard(task)].put(task)
+
+    def qsize(self):
+        return sum(q.qsize() for q in self._queues)
+
+    def is_dispatch_thread(self):
+        ident = threading.get_ident()
+        return ident == self._owner or ident in self._workers
+
+    def drop_oldest(self, droppable):
+        # Tasks aren't ordered across shards; prefer the longest one.
+        for q in sorted(self._queues, key=lambda q: q.qsize(), reverse=True):
+            task = self._drop_oldest(q, droppable)
+            if task is not None:
+                return task
+        return None
+
+    def drain(self):
+        tasks = []
+        for q in self._queues:
+            while True:
+                try:
+                    task = q.get_nowait()
+                except queue.Empty:
+                    break
+                if task is not None:
+                    tasks.append(task)
+        return tasks
+
+    def _work(self, q):
+        self._workers.add(threading.get_ident())
+        while True:
+            task = q.get()
+            if task is None:
+                return
+            try:
+                self.handle(task)
+            except BaseException:
+                # SystemExit and friends stop the whole manager.
+                self._done.set()
+                return
+
+    def run(self):
+        self._owner = threading.get_ident()
+        self._done.clear()
+        self._threads = [
+            threading.Thread(target=self._work, args=(q,), daemon=True,
+                             name="overkill-worker-%d" % i)
+            for i, q in enumerate(self._queues)
+        ]
+        for thread in self._threads:
+            thread.start()
+        # Wait on the main thread so that signals are still delivered.
+        while not self._done.wait(1):
+            pass
+
+    def _stop_workers(self):
+        for q in self._queues:
+            q.put(None)
+        for thread in self._threads:
+            # Don't let a wedged handler block shutdown forever.
+            thread.join(self.join_timeout)
+        self._threads = []
+
+    def flush(self):
+        if self._threads:
+            self._stop_workers()
+        while True:
+            tasks = 0
+            for q in self._queues:
+                while True:
+                    try:
+                        task = q.get_nowait()
+                    except queue.Empty:
+                        break
+                    if task is not None:
+                        tasks += 1
+                        self.handle(task)
+            if not tasks:
+                return
+
+
+class AsyncioDispatcher(Dispatcher):
+    """
+    Runs tasks as callbacks on an asyncio event loop.
+
+    Tasks queued from the loop's own thread are scheduled without waking the
+    loop through its self-pipe and coroutines spawned with spawn() share the
+    loop instead of getting a thread each.
+    """
+
+    def __init__(self, handle):
+        import asyncio
+        self.handle = handle
+        self.loop = asyncio.new_event_loop()
+        self._queue = deque()
+        self._scheduled = False
+        self._thread = None
+
+    def put(self, task):
+        self._queue.append(task)
+        if self._scheduled:
+            return
+        self._scheduled = True
+        if threading.get_ident() == self._thread:
+            self.loop.call_soon(self._run_queued)
+        else:
+            self.loop.call_soon_threadsafe(self._run_queued)
+
+    def _run_queued(self):
+        self._scheduled = False
+        # Only run what's here now so other callbacks get a turn.
+        for _ in range(len(self._queue)):
+            self.handle(self._queue.popleft())
+
+    def qsize(self):
+        return len(self._queue)
+
+    def is_dispatch_thread(self):
+        return threading.get_ident() == self._thread
+
+    def drop_oldest(self, droppable):
+        for i, task in enumerate(self._queue):
+            if droppable(task):
+                del self._queue[i]
+                return task
+        return None
+
+    def drain(self):
+        tasks = list(self._queue)
+        self._queue.clear()
+        return tasks
+
+    def run(self):
+        import asyncio
+        asyncio.set_event_loop(self.loop)
+        self._thread = threading.get_ident()
+        try:
+            self.loop.run_forever()
+        finally:
+            self._thread = None
+
+    def flush(self):
+        import asyncio
+        while True:
+            while self._queue:
+                self.handle(self._queue.popleft())
+            if self.loop.is_closed() or self.loop.is_running():
+                return
+            # Give cancelled coroutines a chance to clean up.
+            self.loop.run_until_complete(asyncio.sleep(0))
+            if not self._queue:
+                return
+
+    def close(self):
+        if self.loop.is_closed():
+            return
+        # Coroutines still running (or being cancelled) get to finish.
+        _finish_tasks(self.loop)
+        self.flush()
+        self.loop.close()
+
+    def spawn(self, coro):
+        import asyncio
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
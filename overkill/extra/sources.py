@@ -15,25 +15,147 @@
 #    along with Overkill.  If not, see <http://www.gnu.org/licenses/>.
 ##
 
-# I like clean scopes and I cannot lie...
-def wrapper():
-    import pkgutil, sys
-    from overkill.sources import Source
-    import overkill.extra as package
-    self = sys.modules[__name__]
-    sources = []
+"""
+Sources provided by plugins, imported on first use.
+
+Plugins either register their sources under the "overkill.sources" entry
+point group (name = class name, value = "module:Class") or put a module in
+the overkill.extra package. Such modules are indexed from their source
+without being imported: every top-level class deriving from a class named
+*Source counts. The index is cached in ~/.cache/overkill and rebuilt when
+an indexed file or installed distribution changes.
+"""
+
+import os
+import sys
+
+ENTRY_POINT_GROUP = "overkill.sources"
 
-    for imp, name, ispkg in pkgutil.iter_modules(package.__path__, prefix=__package__+"."):
-        if ispkg or name == __name__:
+_index_version = 1
+# name -> (module, attribute)
+_index = None
+
+def _cache_file():
+    from overkill.util import xdg_home
+    return os.path.join(
+        xdg_home("XDG_CACHE_HOME", ".cache"), "overkill",
+        "extra-sources.%s.cache" % sys.implementation.cache_tag
+    )
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def _package_modules():
+    import overkill.extra as package
+    for directory in package.__path__:
+        try:
+            entries = sorted(os.scandir(directory), key=lambda entry: entry.name)
+        except OSError:
             continue
-        mod = imp.find_module(name).load_module(name)
-        if mod in sys.modules:
+        for entry in entries:
+            name, ext = os.path.splitext(entry.name)
+            if ext == ".py" and name.isidentifier() and name not in ("__init__", "sources"):
+                yield "%s.%s" % (package.__name__, name), entry.path
+
+def _validity():
+    # What the index depends on: the plugin modules' sources and the
+    # directories distributions are installed to.
+    return (
+        tuple((path, _stat(path)) for _, path in _package_modules()),
+        tuple((entry, _stat(entry)) for entry in sys.path if isinstance(entry, str)),
+    )
+
+def _scan_module(path):
+    import ast
+    with open(path, "rb") as f:
+        tree = ast.parse(f.read(), path)
+    sources = set()
+    for node in tree.body:
+        if not isinstance(node, ast.ClassDef) or node.name.startswith("_"):
             continue
-        for k,v in mod.__dict__.items():
-            if type(v) is type and issubclass(v, Source):
-                setattr(self, k, v)
-                sources.append(k)
+        for base in node.bases:
+            base = base.attr if isinstance(base, ast.Attribute) else getattr(base, "id", "")
+            if base.endswith("Source") or base in sources:
+                sources.add(node.name)
+                break
     return sources
 
-__all__ = wrapper()
-del wrapper
+def _entry_points():
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        return ()
+    try:
+        return entry_points(group=ENTRY_POINT_GROUP)
+    except TypeError:
+        # Python < 3.10
+        return entry_points().get(ENTRY_POINT_GROUP, ())
+
+def _build_index():
+    index = {}
+    for module, path in _package_modules():
+        try:
+            names = _scan_module(path)
+        except (OSError, SyntaxError, ValueError):
+            continue
+        for name in names:
+            index.setdefault(name, (module, name))
+    for entry_point in _entry_points():
+        module, _, attr = entry_point.value.partition(":")
+        index.setdefault(entry_point.name, (module.strip(), attr.strip() or entry_point.name))
+    return index
+
+def _load_index():
+    import marshal
+    validity = _validity()
+    cache = _cache_file()
+    try:
+        with open(cache, "rb") as f:
+            version, cached_validity, index = marshal.load(f)
+        if version == _index_version and cached_validity == validity:
+            return index
+    except (OSError, ValueError, EOFError, TypeError):
+        pass
+    index = _build_index()
+    try:
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        tmp = "%s.%d" % (cache, os.getpid())
+        with open(tmp, "wb") as f:
+            marshal.dump((_index_version, validity, index), f)
+        os.replace(tmp, cache)
+    except OSError:
+        pass
+    return index
+
+def index():
+    """ Return {source name: (module, attribute)} without importing anything """
+    global _index
+    if _index is None:
+        _index = _load_index()
+    return _index
+
+def __getattr__(name):
+    import importlib
+    from overkill.sources import Source
+    if name == "__all__":
+        return tuple(sorted(index()))
+    if name.startswith("__"):
+        # Don't build the index for introspection (__path__, __wrapped__...)
+        raise AttributeError(name)
+    try:
+        module, attr = index()[name]
+    except KeyError:
+        raise AttributeError("no source named %r" % (name,)) from None
+    value = getattr(importlib.import_module(module), attr)
+    if not (isinstance(value, type) and issubclass(value, Source)):
+        raise AttributeError("%s.%s is not a Source" % (module, attr))
+    # Only look it up once.
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(index()))
@@ -0,0 +1,148 @@
+##
+#    This file is part of Overkill.
+#
+#    Overkill is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Overkill is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Overkill.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""
+A minimal inotify binding (ctypes for the syscalls, struct for the events).
+
+Events are parsed from whole read() buffers at once; Event mirrors the
+attributes of pyinotify's events (wd, mask, cookie, name, path, pathname,
+dir, maskname) so sinks written against either work unchanged.
+"""
+
+import os
+import struct
+
+IN_ACCESS = 0x00000001
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_CLOSE_NOWRITE = 0x00000010
+IN_OPEN = 0x00000020
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_MASK_ADD = 0x20000000
+IN_ISDIR = 0x40000000
+IN_ONESHOT = 0x80000000
+
+IN_CLOSE = IN_CLOSE_WRITE | IN_CLOSE_NOWRITE
+IN_MOVE = IN_MOVED_FROM | IN_MOVED_TO
+ALL_EVENTS = 0x00000fff
+
+IN_CLOEXEC = os.O_CLOEXEC
+IN_NONBLOCK = os.O_NONBLOCK
+
+_NAMES = tuple(
+    (value, name) for name, value in sorted(globals().items())
+    if name.startswith("IN_") and name not in ("IN_CLOSE", "IN_MOVE", "IN_CLOEXEC", "IN_NONBLOCK")
+)
+
+_header = struct.Struct("iIII")
+
+_libc = None
+
+def _call(name, *args):
+    global _libc
+    # ctypes is only imported once inotify is actually used.
+    import ctypes
+    if _libc is None:
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        _libc = libc
+    ret = getattr(_libc, name)(*args)
+    if ret < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+    return ret
+
+def init(flags=IN_CLOEXEC|IN_NONBLOCK):
+    """ Create an inotify instance and return its file descriptor. """
+    return _call("inotify_init1", flags)
+
+def add_watch(fd, path, mask):
+    """ Add (or replace) the watch on path and return its watch descriptor. """
+    return _call("inotify_add_watch", fd, os.fsencode(path), mask)
+
+def rm_watch(fd, wd):
+    _call("inotify_rm_watch", fd, wd)
+
+def maskname(mask):
+    return "|".join(name for value, name in _NAMES if mask & value == value)
+
+
+class Event:
+    __slots__ = ("wd", "mask", "cookie", "name", "path")
+
+    def __init__(self, wd, mask, cookie, name, path):
+        self.wd = wd
+        self.mask = mask
+        self.cookie = cookie
+        self.name = name
+        self.path = path
+
+    @property
+    def pathname(self):
+        if self.name:
+            return os.path.join(self.path, self.name)
+        return self.path
+
+    @property
+    def dir(self):
+        return bool(self.mask & IN_ISDIR)
+
+    @property
+    def maskname(self):
+        return maskname(self.mask)
+
+    def __repr__(self):
+        return "<Event %s %r>" % (self.maskname, self.pathname)
+
+
+def parse(buf, paths):
+    """
+    Parse a buffer of inotify events.
+
+    paths maps watch descriptors to the watched paths. Events for unknown
+    watch descriptors are still returned (with path set to None); the
+    overflow event has wd -1.
+    """
+    events = []
+    unpack = _header.unpack_from
+    size = _header.size
+    get_path = paths.get
+    offset = 0
+    end = len(buf)
+    while offset < end:
+        wd, mask, cookie, length = unpack(buf, offset)
+        offset += size
+        if length:
+            name = os.fsdecode(buf[offset:offset + length].rstrip(b"\0"))
+            offset += length
+        else:
+            name = ""
+        events.append(Event(wd, mask, cookie, name, get_path(wd)))
+    return events
@@ -0,0 +1,284 @@
+##
+#    This file is part of Overkill.
+#
+#    Overkill is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Overkill is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Overkill.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""
+Run sources in child processes so that CPU-bound ones neither hold the GIL
+against the manager nor against each other.
+
+An IsolatedSource is a proxy: add it with manager.add_source() and, on its
+first subscription, it forks a child that runs source_class with a manager
+of its own. Updates come back through a ring buffer in shared memory, with
+an eventfd to wake up the parent; subscriptions go to the child through a
+pipe. The child is forked (not spawned), so sources defined in the
+configuration work as they are.
+"""
+
+import mmap
+import os
+import pickle
+import select
+import struct
+from .sinks import Sink
+from .sources import Source, RawFile, get_fdsource
+from .remote import SUBSCRIBE, UNSUBSCRIBE, UPDATES, UNSUBSCRIBED, _dumps, _frame, _unframe
+from .util import _pickle_dumps
+from . import manager
+
+__all__ = ("IsolatedSource",)
+
+class _Ring:
+    """
+    A single producer, single consumer ring of byte strings in shared memory.
+
+    The header holds the number of bytes ever written and read; each side
+    only writes its own counter, after the data it covers.
+    """
+    _header = struct.Struct("QQ")
+    _counter = struct.Struct("Q")
+    _length = struct.Struct("I")
+    # Skip to the start of the buffer.
+    _wrap = 0xffffffff
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        # Anonymous and shared: inherited by forked children.
+        self._mem = mmap.mmap(-1, self._header.size + capacity)
+
+    def put(self, data):
+        """ Append data; returns False if there's no room for it (yet) """
+        mem, capacity = self._mem, self.capacity
+        needed = self._length.size + len(data)
+        if needed > capacity:
+            raise ValueError("%d bytes don't fit in the ring" % len(data))
+        written, read = self._header.unpack_from(mem)
+        position = written % capacity
+        tail = capacity - position
+        if tail < needed:
+            if written + tail + needed - read > capacity:
+                return False
+            if tail >= self._length.size:
+                self._length.pack_into(mem, self._header.size + position, self._wrap)
+            written += tail
+            position = 0
+        elif written + needed - read > capacity:
+            return False
+        start = self._header.size + position
+        self._length.pack_into(mem, start, len(data))
+        mem[start + self._length.size:start + needed] = data
+        self._counter.pack_into(mem, 0, written + needed)
+        return True
+
+    def get_all(self):
+        """ Remove and return everything in the ring """
+        mem, capacity = self._mem, self.capacity
+        written, read = self._header.unpack_from(mem)
+        items = []
+        while read < written:
+            position = read % capacity
+            tail = capacity - position
+            if tail < self._length.size:
+                read += tail
+                continue
+            start = self._header.size + position
+            (size,) = self._length.unpack_from(mem, start)
+            if size == self._wrap:
+                read += tail
+                continue
+            start += self._length.size
+            items.append(mem[start:start + size])
+            read += self._length.size + size
+        self._counter.pack_into(mem, self._counter.size, read)
+        return items
+
+    def close(self):
+        self._mem.close()
+
+class _Host(Sink):
+    """ Serves the proxy's subscriptions in the child """
+    coalesce_updates = False
+
+    def __init__(self, source, ring, notify, space, control):
+        super().__init__()
+        self.source = source
+        self._ring = ring
+        self._notify = notify
+        self._space = space
+        self._control = control
+        self._received = bytearray()
+        self._parent = os.getppid()
+
+    def start(self):
+        if super().start():
+            self.subscribe_to(RawFile(self._control), get_fdsource())
+            return True
+        return False
+
+    def handle_updates(self, updates, source):
+        if source is self.source:
+            subscriptions = self.subscriptions
+            if not all(key in subscriptions for key in updates):
+                updates = {k: v for k, v in updates.items() if k in subscriptions}
+            if updates:
+                self._put(UPDATES, updates)
+            return
+        chunk = updates.get(RawFile(self._control))
+        if not chunk:
+            return
+        self._received += chunk
+        for op, arg in _unframe(self._received, pickle.loads):
+            if op == SUBSCRIBE:
+                if arg in self.subscriptions:
+                    continue
+                if self.source.is_publishing(arg):
+                    self.subscribe_to(arg, self.source)
+                else:
+                    self._put(UNSUBSCRIBED, arg)
+            elif op == UNSUBSCRIBE and arg in self.subscriptions:
+                self.unsubscribe_from(arg, self.source)
+
+    def handle_unsubscribe(self, subscription, source):
+        if source is self.source:
+            self._put(UNSUBSCRIBED, subscription)
+        else:
+            # The proxy stopped (or the parent died).
+            manager.stop()
+
+    def _put(self, op, arg):
+        data = _dumps([(op, arg)], _pickle_dumps)
+        try:
+            while not self._ring.put(data):
+                # Full; wait for the parent to catch up.
+                if select.select([self._space], [], [], 1)[0]:
+                    os.eventfd_read(self._space)
+                elif os.getppid() != self._parent:
+                    return
+        except ValueError:
+            import traceback
+            traceback.print_exc()
+            return
+        os.eventfd_write(self._notify, 1)
+
+def _host(source_class, args, kwargs, ring, notify, space, control, parent_control):
+    from . import sources
+    # Only this thread survived the fork; start over.
+    manager._after_fork()
+    sources._after_fork()
+    os.close(parent_control)
+    manager.add_sink(_Host(
+        source_class(*args, **kwargs), ring, notify, space,
+        open(control, "rb", buffering=0)
+    ))
+    manager.run()
+
+class IsolatedSource(Sink, Source):
+    """
+    Runs source_class(*source_args, **source_kwargs) in a child process.
+
+    Publishes what source_class publishes (or publishes, if set). Batches
+    of updates bigger than ring_size are dropped. If the child dies, the
+    proxy stops (unsubscribing its subscribers).
+    """
+    source_class = None
+    source_args = ()
+    source_kwargs = {}
+    ring_size = 1 << 20
+    # How long to wait for the child to shut down before killing it.
+    stop_timeout = 5
+    # Only reads from the eventfd; the ring holds the data.
+    coalesce_updates = False
+
+    _process = None
+
+    def is_publishing(self, subscription):
+        return self._can_publish() and \
+            subscription in (self.publishes or self.source_class.publishes)
+
+    def start(self):
+        if super().start():
+            self._spawn()
+            return True
+        return False
+
+    def _spawn(self):
+        import multiprocessing
+        self._ring = _Ring(self.ring_size)
+        notify = os.eventfd(0, os.EFD_CLOEXEC)
+        self._space = os.eventfd(0, os.EFD_CLOEXEC | os.EFD_NONBLOCK)
+        control, self._control = os.pipe()
+        self._process = multiprocessing.get_context("fork").Process(
+            target=_host, daemon=True,
+            name="%s(%s)" % (type(self).__name__, self.source_class.__name__),
+            args=(
+                self.source_class, self.source_args, self.source_kwargs,
+                self._ring, notify, self._space, control, self._control
+            )
+        )
+        self._process.start()
+        os.close(control)
+        self._notify = open(notify, "rb", buffering=0)
+        self.subscribe_to(RawFile(self._notify), get_fdsource())
+        self._sentinel = open(self._process.sentinel, "rb", buffering=0, closefd=False)
+        get_fdsource().call_when_readable(
+            self._sentinel, IsolatedSource._exited, self, self._process
+        )
+
+    def _send(self, op, arg):
+        if self._process is not None:
+            os.write(self._control, _frame([(op, arg)], _pickle_dumps))
+
+    def on_subscribe(self, subscriber, subscription):
+        if len(self.subscribers[subscription]) == 1:
+            self._send(SUBSCRIBE, subscription)
+
+    def on_unsubscribe(self, subscriber, subscription):
+        if subscription not in self.subscribers:
+            self._send(UNSUBSCRIBE, subscription)
+
+    def handle_updates(self, updates, source):
+        if self._process is None:
+            return
+        for data in self._ring.get_all():
+            for op, arg in pickle.loads(data):
+                if op == UPDATES:
+                    self.push_updates(arg)
+                elif op == UNSUBSCRIBED:
+                    self.push_unsubscribe(arg)
+        os.eventfd_write(self._space, 1)
+
+    def handle_unsubscribe(self, subscription, source):
+        pass
+
+    def _exited(self, process):
+        if process is self._process:
+            self.stop()
+
+    def stop(self):
+        if super().stop():
+            process, self._process = self._process, None
+            get_fdsource().cancel_readable(self._sentinel)
+            os.close(self._control)
+            if process.is_alive():
+                process.terminate()
+                process.join(self.stop_timeout)
+                if process.is_alive():
+                    process.kill()
+            process.join()
+            get_fdsource().close_file(self._notify)
+            os.close(self._space)
+            self._ring.close()
+            return True
+        return False
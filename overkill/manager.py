@@ -19,6 +19,20 @@
 
 manager = None
 class Manager:
+    # Merge pending calls that share a coalescing key (see queued).
+    coalesce = False
+    # SIGUSR2 profiles the running manager (see profile()).
+    profile_mode = "sample"
+    profile_duration = 30
+    profile_dir = None
+    # Maximum number of queued calls (0 for no limit) and what to do when a
+    # call is queued while full: "block" the queuing thread (never a
+    # dispatch thread), "drop-oldest" or "drop-newest" call, or "coalesce"
+    # mergeable calls (see queued) and block for the rest. Only mergeable
+    # calls are ever dropped; the others block as with "block".
+    queue_size = 0
+    overflow = "block"
+
     def add_source(self, source):
         self.aggregator.add_source(source)
 
@@ -26,10 +40,84 @@ class Manager:
         self.__sinks.add(sink)
 
     def __init__(self):
-        import queue
+        import threading, time
+        from overkill.dispatch import Dispatcher
+        self.__clock = time.monotonic
+        self.__metrics = None
+        self.__state = None
+        self.__profile = None
         self.__sinks = set()
         self.__aggregator = None
-        self.__queue = queue.Queue()
+        self.__workers = 1
+        self.__backend = "thread"
+        self.__dispatcher = Dispatcher(self.__handle_task)
+        self.__pending = {}
+        self.__pending_lock = threading.Lock()
+        self.__space = threading.Condition()
+        self.__space_waiters = 0
+        self.__overflows = {
+            "blocked": 0, "dropped-oldest": 0, "dropped-newest": 0, "coalesced": 0
+        }
+
+    @property
+    def workers(self):
+        return self.__workers
+
+    @workers.setter
+    def workers(self, workers):
+        """
+        Set the number of dispatch threads. With more than one, calls queued
+        on different objects may run in parallel but each object still sees
+        its own calls in order.
+        """
+        from overkill.dispatch import Dispatcher, PoolDispatcher
+        if workers < 1:
+            raise ValueError("need at least one worker")
+        if workers > 1 and self.__backend != "thread":
+            raise ValueError("worker pools need the thread backend")
+        if workers == 1:
+            self.__set_dispatcher(Dispatcher(self.__handle_task))
+        else:
+            self.__set_dispatcher(PoolDispatcher(self.__handle_task, workers))
+        self.__workers = workers
+
+    @property
+    def backend(self):
+        return self.__backend
+
+    @backend.setter
+    def backend(self, backend):
+        """
+        Select how queued calls are run: "thread" (a blocking queue, see
+        workers) or "asyncio" (callbacks on an event loop).
+        """
+        from overkill.dispatch import Dispatcher, AsyncioDispatcher
+        if backend == "thread":
+            self.__set_dispatcher(Dispatcher(self.__handle_task))
+        elif backend == "asyncio":
+            self.__set_dispatcher(AsyncioDispatcher(self.__handle_task))
+        else:
+            raise ValueError("unknown backend: %r" % (backend,))
+        self.__backend = backend
+        self.__workers = 1
+
+    @property
+    def loop(self):
+        """ The event loop of the asyncio backend (None otherwise) """
+        return getattr(self.__dispatcher, "loop", None)
+
+    def __set_dispatcher(self, dispatcher):
+        old = self.__dispatcher
+        self.__dispatcher = dispatcher
+        for task in old.drain():
+            dispatcher.put(task)
+
+    def spawn(self, coro):
+        """
+        Run a coroutine for a source. Returns a concurrent.futures.Future
+        that can be used to cancel it.
+        """
+        return self.__dispatcher.spawn(coro)
 
     @property
     def aggregator(self):
@@ -38,41 +126,234 @@ class Manager:
             self.__aggregator = Aggregator()
         return self.__aggregator
 
-    def queued(self, fn):
+    def queued(self, fn=None, key=None, merge=None):
+        """
+        Decorate fn such that calls are queued instead of run immediately.
+
+        If key and merge are given and coalescing is enabled, a call whose
+        key(*args) matches that of a call still waiting in the queue is
+        folded into it with merge(old_args, new_args) instead of being
+        queued separately. A key of None opts a call out.
+        """
+        import functools
+        if fn is None:
+            return lambda fn: self.queued(fn, key, merge)
+        # The unqueued function stays reachable as do.__wrapped__.
+        @functools.wraps(fn)
         def do(*args, **kwargs):
-            self.queue(fn, args, kwargs)
+            self.queue(fn, args, kwargs, key, merge)
         return do
-    
-    def queue(self, fn, args=None, kwargs=None):
-        self.__queue.put((fn, args, kwargs))
 
-    def __flush_queue(self):
-        import queue
-        while self.__queue:
+    def queue(self, fn, args=None, kwargs=None, key=None, merge=None):
+        queued_at = None if self.__metrics is None else self.__clock()
+        full = self.backpressured
+        coalesce = self.coalesce or full and self.overflow == "coalesce"
+        dropping = self.queue_size and self.overflow in ("drop-oldest", "drop-newest")
+        task = None
+        if key is not None and (coalesce or dropping):
+            key = key(*(args or ()))
+            # Calls that may be merged may also be dropped.
+            droppable = key is not None
+            if droppable and coalesce:
+                key = (fn, key)
+                with self.__pending_lock:
+                    task = self.__pending.get(key)
+                    if task is not None:
+                        task[1] = merge(task[1], args)
+                        if full:
+                            self.__overflows["coalesced"] += 1
+                        return
+                    task = self.__pending[key] = [fn, args, kwargs, key, queued_at, True]
+        else:
+            droppable = False
+        if task is None:
+            task = (fn, args, kwargs, None, queued_at, droppable)
+        if full and not self.__make_room(task):
+            return
+        self.__dispatcher.put(task)
+
+    @property
+    def backpressured(self):
+        """ Whether the queue is full (see queue_size) """
+        return bool(self.queue_size) and self.__dispatcher.qsize() >= self.queue_size
+
+    @property
+    def overflows(self):
+        """ How often each overflow policy kicked in """
+        return dict(self.__overflows)
+
+    def wait_for_space(self, timeout=None):
+        """
+        Wait until the queue isn't full (see queue_size). Returns False if
+        the timeout expired first.
+        """
+        if not self.queue_size:
+            return True
+        with self.__space:
+            self.__space_waiters += 1
             try:
-                task = self.__queue.get_nowait()
-            except queue.Empty:
-                return
-            self.__handle_task(task)
+                return self.__space.wait_for(lambda: not self.backpressured, timeout)
+            finally:
+                self.__space_waiters -= 1
+
+    def __make_room(self, task):
+        policy = self.overflow
+        if policy == "drop-newest" and task[5]:
+            self.__discard(task)
+            self.__overflows["dropped-newest"] += 1
+            return False
+        if policy == "drop-oldest":
+            dropped = self.__dispatcher.drop_oldest(lambda task: task[5])
+            if dropped is not None:
+                self.__discard(dropped)
+                self.__overflows["dropped-oldest"] += 1
+                return True
+        # Blocking a dispatch thread would deadlock; go over the limit.
+        if not self.__dispatcher.is_dispatch_thread():
+            self.__overflows["blocked"] += 1
+            self.wait_for_space()
+        return True
+
+    def __discard(self, task):
+        if task[3] is not None:
+            with self.__pending_lock:
+                self.__pending.pop(task[3], None)
+
+    def __flush_queue(self):
+        self.__dispatcher.flush()
 
     def __handle_task(self, task):
-        fn, args, kwargs = task
+        key = task[3]
+        if key is not None:
+            # Stop merging into this task before reading its arguments.
+            with self.__pending_lock:
+                self.__pending.pop(key, None)
+        fn, args, kwargs, _, queued_at, _ = task
+        if self.__space_waiters:
+            with self.__space:
+                self.__space.notify_all()
+        metrics = self.__metrics
+        if metrics is not None:
+            started = self.__clock()
+        session = self.__profile
         try:
-            fn(*(args or ()), **(kwargs or {}))
+            if session is None:
+                fn(*(args or ()), **(kwargs or {}))
+            else:
+                session.call(fn, args or (), kwargs or {})
         except Exception:
             import traceback
             traceback.print_exc()
+        if metrics is not None:
+            metrics.record_task(
+                fn, args,
+                None if queued_at is None else started - queued_at,
+                self.__clock() - started,
+                self.__dispatcher.qsize()
+            )
+
+    @property
+    def metrics(self):
+        """ The Metrics being collected (None unless enable_metrics() was called) """
+        return self.__metrics
+
+    def enable_metrics(self):
+        """
+        Start recording queue depth, queue wait and handler times and
+        published events. SIGUSR1 dumps them to stderr (see overkill.metrics).
+        """
+        from overkill.metrics import Metrics
+        if self.__metrics is None:
+            self.__metrics = Metrics()
+        return self.__metrics
+
+    @property
+    def state(self):
+        """ The StateStore in use (None unless enable_state() was called) """
+        return self.__state
+
+    def enable_state(self, path=None, interval=10):
+        """
+        Save what sources with persist_state set publish to path (a file in
+        $XDG_STATE_HOME/overkill by default) every interval seconds, and hand
+        out the saved values, marked stale, until those sources publish again
+        after a restart (see overkill.state). Call before anything subscribes.
+        """
+        import os
+        from overkill.state import StateStore
+        from overkill.util import xdg_home
+        if self.__state is None:
+            if path is None:
+                path = os.path.join(xdg_home("XDG_STATE_HOME", ".local/state"), "overkill", "state")
+            self.__state = StateStore(path, interval)
+        return self.__state
+
+    def profile(self, duration=None, mode=None, path=None):
+        """
+        Profile the running manager for duration seconds (profile_duration by
+        default) in the background and write the result to path (a new file
+        in profile_dir, or $XDG_RUNTIME_DIR/overkill, by default). mode is
+        "sample" or "cprofile" (see overkill.profiling). Returns the path, or
+        None if a profile is already being taken.
+        """
+        from overkill.profiling import SamplingSession, CProfileSession, profile_path
+        if self.__profile is not None:
+            return None
+        mode = mode or self.profile_mode
+        if mode == "sample":
+            session_type = SamplingSession
+        elif mode == "cprofile":
+            if self.__workers > 1:
+                raise ValueError("cprofile mode needs a single worker; use sample mode")
+            session_type = CProfileSession
+        else:
+            raise ValueError("unknown profile mode: %r" % (mode,))
+        session = session_type(
+            duration or self.profile_duration,
+            path or profile_path(self.profile_dir, session_type.extension),
+            self.__end_profile
+        )
+        self.__profile = session
+        session.start()
+        return session.path
+
+    def __end_profile(self, session):
+        if self.__profile is session:
+            self.__profile = None
+
+    def _after_fork(self):
+        """ Start over with an empty manager in a forked child """
+        self.__init__()
+
+    def stop(self):
+        """ Make run() return (after the usual shutdown) """
+        import sys
+        self.queue(sys.exit)
+
+    def __on_signal(self, fn):
+        # Signal handlers run on the dispatch thread: an error must not stop
+        # the manager.
+        try:
+            fn()
+        except Exception:
+            import traceback
+            traceback.print_exc()
+
+    def __dump_metrics(self):
+        if self.__metrics is not None:
+            self.__metrics.dump()
 
     def run(self):
         import signal
 
         signal.signal(signal.SIGTERM, lambda signal, frame: sys.exit(0))
+        signal.signal(signal.SIGUSR1, lambda signal, frame: self.__on_signal(self.__dump_metrics))
+        signal.signal(signal.SIGUSR2, lambda signal, frame: self.__on_signal(self.profile))
 
         try:
             for sink in self.__sinks:
                 sink.start()
-            while True:
-                self.__handle_task(self.__queue.get())
+            self.__dispatcher.run()
         except SystemExit:
             pass
         except KeyboardInterrupt:
@@ -93,6 +374,9 @@ class Manager:
             if self.__aggregator is not None:
                 self.__aggregator.stop()
                 self.__flush_queue()
+            self.__dispatcher.close()
+            if self.__state is not None:
+                self.__state.close()
 
 import sys
 
@@ -0,0 +1,185 @@
+##
+#    This file is part of Overkill.
+#
+#    Overkill is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Overkill is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Overkill.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+import sys
+import json
+from threading import RLock
+from .sources import Source, get_timersource
+from . import manager
+
+__all__ = ("Histogram", "Metrics", "MetricsSource")
+
+
+class Histogram:
+    """
+    A histogram with power-of-two buckets.
+
+    Values are scaled (seconds to microseconds by default) and counted in
+    bucket n if they are below 2**n, so percentiles are upper bounds.
+    """
+    __slots__ = ("scale", "count", "total", "max", "buckets")
+
+    def __init__(self, scale=1e6):
+        self.scale = scale
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets = []
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        bucket = int(value*self.scale).bit_length()
+        if bucket >= len(self.buckets):
+            self.buckets.extend([0]*(bucket + 1 - len(self.buckets)))
+        self.buckets[bucket] += 1
+
+    def percentile(self, p):
+        wanted = self.count*p
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= wanted:
+                return (2**bucket)/self.scale
+        return 0
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "mean": self.total/self.count if self.count else 0,
+            "max": self.max,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+        }
+
+
+class Metrics:
+    """
+    Runtime statistics collected by the manager (see
+    Manager.enable_metrics()).
+
+    Queue wait (enqueue to dispatch) and handler run times are kept per
+    (target class, method); published events are counted per (source
+    class, subscription); subprocess spawn times and restarts per class.
+    """
+
+    def __init__(self):
+        self._lock = RLock()
+        self.queue_depth = Histogram(scale=1)
+        self.wait = {}
+        self.run = {}
+        self.events = {}
+        self.spawn = {}
+        self.restarts = {}
+
+    def record_task(self, fn, args, waited, ran, depth):
+        target = args[0] if args else getattr(fn, "__self__", None)
+        key = (type(target).__name__, getattr(fn, "__name__", repr(fn)))
+        with self._lock:
+            self.queue_depth.add(depth)
+            if waited is not None:
+                try:
+                    self.wait[key].add(waited)
+                except KeyError:
+                    self.wait[key] = histogram = Histogram()
+                    histogram.add(waited)
+            try:
+                self.run[key].add(ran)
+            except KeyError:
+                self.run[key] = histogram = Histogram()
+                histogram.add(ran)
+
+    def count_events(self, source, updates):
+        name = type(source).__name__
+        with self._lock:
+            for subscription in updates:
+                key = (name, subscription)
+                self.events[key] = self.events.get(key, 0) + 1
+
+    def record_spawn(self, process, seconds):
+        name = type(process).__name__
+        with self._lock:
+            try:
+                self.spawn[name].add(seconds)
+            except KeyError:
+                self.spawn[name] = histogram = Histogram()
+                histogram.add(seconds)
+
+    def count_restart(self, process):
+        name = type(process).__name__
+        with self._lock:
+            self.restarts[name] = self.restarts.get(name, 0) + 1
+
+    def snapshot(self):
+        """ Return the current statistics as plain (JSON-able) data """
+        def by_task(histograms):
+            return {
+                "%s.%s" % key: histogram.as_dict()
+                for key, histogram in histograms.items()
+            }
+        with self._lock:
+            return {
+                "queue_depth": self.queue_depth.as_dict(),
+                "overflows": manager.overflows,
+                "wait": by_task(self.wait),
+                "run": by_task(self.run),
+                "events": {
+                    "%s[%r]" % key: count
+                    for key, count in self.events.items()
+                },
+                "spawn": {
+                    name: histogram.as_dict()
+                    for name, histogram in self.spawn.items()
+                },
+                "restarts": dict(self.restarts),
+            }
+
+    def dump(self, file=None):
+        json.dump(self.snapshot(), file or sys.stderr, indent=2, sort_keys=True)
+        (file or sys.stderr).write("\n")
+
+
+class MetricsSource(Source):
+    """
+    Publishes the manager's metrics snapshot as "metrics" every interval
+    seconds while subscribed. Enables metrics collection if necessary.
+    """
+    publishes = ["metrics"]
+    interval = 5
+
+    def __init__(self):
+        super().__init__()
+        self._timer = None
+
+    def on_start(self):
+        self._metrics = manager.enable_metrics()
+        self._publish()
+
+    def on_stop(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _publish(self):
+        if not self.running:
+            return
+        self.push_updates({"metrics": self._metrics.snapshot()})
+        self._timer = get_timersource().call_later(
+            self.interval, MetricsSource._publish, self, slack=self.interval/2
+        )
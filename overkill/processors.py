@@ -22,6 +22,8 @@ __all__=("Aggregator",)
 
 class Aggregator(Sink, Source):
     """ A Proxy Class to manage data sources """
+    # Maximum number of remembered routes (including negative ones).
+    route_cache_size = 4096
 
     def is_publishing(self, subscription):
         return self.who_publishes(subscription) is not None
@@ -29,12 +31,44 @@ class Aggregator(Sink, Source):
     def __init__(self):
         super().__init__()
         self.sources = []
+        self._candidates = {}
+        self._routes = {}
 
     def who_publishes(self, subscription):
-        for source in self.sources:
-            if source.is_publishing(subscription):
-                return source
-        return None
+        try:
+            return self._routes[subscription]
+        except KeyError:
+            pass
+        source = None
+        for candidate in self._candidates_for(type(subscription)):
+            if candidate.is_publishing(subscription):
+                source = candidate
+                break
+        if len(self._routes) >= self.route_cache_size:
+            self._routes.clear()
+        self._routes[subscription] = source
+        return source
+
+    def _candidates_for(self, kind):
+        try:
+            return self._candidates[kind]
+        except KeyError:
+            pass
+        candidates = self._candidates[kind] = [
+            source for source in self.sources
+            if source.subscription_types is None
+            or issubclass(kind, tuple(source.subscription_types))
+        ]
+        return candidates
+
+    def invalidate_routes(self):
+        """ Forget cached routes (e.g. when a source starts publishing more) """
+        self._candidates.clear()
+        self._routes.clear()
+
+    def is_stale(self, subscription):
+        source = self.who_publishes(subscription)
+        return source is not None and source.is_stale(subscription)
 
     def on_subscribe(self, subscriber, subscription):
         if subscription not in self.subscriptions:
@@ -48,3 +82,4 @@ class Aggregator(Sink, Source):
 
     def add_source(self, source):
         self.sources.append(source)
+        self.invalidate_routes()
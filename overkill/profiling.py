@@ -0,0 +1,161 @@
+##
+#    This file is part of Overkill.
+#
+#    Overkill is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Overkill is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Overkill.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""
+On-demand profiling of a running manager (see Manager.profile()).
+
+"sample" mode periodically samples the stacks of every thread (dispatch
+and source threads alike) and writes them in the collapsed-stack format
+understood by flamegraph tools. "cprofile" mode runs every queued call
+under cProfile and writes pstats data; it only covers the dispatch thread
+(and so needs a single worker) but gives exact call counts and times.
+"""
+
+import os
+import sys
+import time
+import threading
+from collections import Counter
+
+__all__ = ("SamplingSession", "CProfileSession", "profile_path")
+
+
+def profile_path(directory, extension):
+    """
+    Create a new, empty file for a profile in directory
+    ($XDG_RUNTIME_DIR/overkill, or ~/.cache/overkill, by default) and
+    return its path.
+    """
+    if directory is None:
+        from .util import xdg_home
+        directory = os.path.join(
+            os.environ.get("XDG_RUNTIME_DIR") or xdg_home("XDG_CACHE_HOME", ".cache"),
+            "overkill"
+        )
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+    base = os.path.join(directory, "overkill-%d-%s" % (os.getpid(), time.strftime("%Y%m%d-%H%M%S")))
+    path = "%s.%s" % (base, extension)
+    n = 0
+    while True:
+        try:
+            # Never reuse (or follow) whatever is already there.
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC, 0o600))
+            return path
+        except FileExistsError:
+            n += 1
+            path = "%s-%d.%s" % (base, n, extension)
+
+def _open_profile(path, mode):
+    # Don't write through a symlink someone else put there.
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW | os.O_CLOEXEC, 0o600)
+    return open(fd, mode)
+
+
+class SamplingSession:
+    extension = "collapsed"
+    interval = 0.005
+
+    def __init__(self, duration, path, on_done):
+        self.duration = duration
+        self.path = path
+        self.on_done = on_done
+        self.samples = Counter()
+        self._thread = threading.Thread(
+            target=self._run, daemon=True, name="overkill-profiler"
+        )
+
+    def start(self):
+        self._thread.start()
+
+    def call(self, fn, args, kwargs):
+        return fn(*args, **kwargs)
+
+    @staticmethod
+    def _frame_name(frame):
+        code = frame.f_code
+        return "%s:%s" % (
+            os.path.basename(code.co_filename),
+            getattr(code, "co_qualname", code.co_name)
+        )
+
+    def _sample(self):
+        me = threading.get_ident()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(self._frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            self.samples[";".join(reversed(stack))] += 1
+
+    def _run(self):
+        end = time.monotonic() + self.duration
+        try:
+            while time.monotonic() < end:
+                self._sample()
+                time.sleep(self.interval)
+        finally:
+            self.on_done(self)
+        with _open_profile(self.path, "w") as f:
+            for stack, count in self.samples.most_common():
+                f.write("%s %d\n" % (stack, count))
+        sys.stderr.write("overkill: wrote profile to %s\n" % self.path)
+
+
+class CProfileSession:
+    """
+    Profiles the calls run by a single dispatch thread (cProfile only allows
+    one active profiler per interpreter as of Python 3.12).
+    """
+    extension = "pstats"
+
+    def __init__(self, duration, path, on_done):
+        import cProfile
+        self.duration = duration
+        self.path = path
+        self.on_done = on_done
+        self._profile = cProfile.Profile()
+        self._calls = 0
+        self._lock = threading.Lock()
+        self._timer = threading.Timer(duration, self._finish)
+        self._timer.daemon = True
+
+    def start(self):
+        self._timer.start()
+
+    def call(self, fn, args, kwargs):
+        # The lock only keeps _finish from reading the profile mid-call.
+        with self._lock:
+            self._calls += 1
+            return self._profile.runcall(fn, *args, **kwargs)
+
+    def _finish(self):
+        import pstats
+        self.on_done(self)
+        with self._lock:
+            if not self._calls:
+                sys.stderr.write("overkill: nothing ran while profiling\n")
+                return
+            stats = pstats.Stats(self._profile)
+        # As stats.dump_stats(), which would follow symlinks.
+        import marshal
+        with _open_profile(self.path, "wb") as f:
+            marshal.dump(stats.stats, f)
+        sys.stderr.write("overkill: wrote profile to %s\n" % self.path)
@@ -0,0 +1,362 @@
+##
+#    This file is part of Overkill.
+#
+#    Overkill is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Overkill is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Overkill.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""
+Share sources between processes over a Unix domain socket.
+
+An ExportSink exports a source (the manager's Aggregator by default) on
+socket_path. A RemoteSource in another process connects to it and
+publishes whatever is subscribed to through it as if it were a local
+source. Every remote process gets one subscriber in the exporting process,
+so updates are fanned out once per process and then again locally.
+
+Messages are pickled into length-prefixed frames. Everything queued while
+a socket is busy goes out in one frame, with updates to the same key
+merged. Only builtin data (None, bools, numbers, strings, bytes, tuples,
+lists, dicts and sets) is pickled, and nothing else is unpickled, so a
+peer can't make the other end run code; subscriptions and published
+values that are anything else aren't sent. The socket is only accessible
+to its owner and both ends refuse peers running as another user.
+"""
+
+import io
+import os
+import pickle
+import struct
+from .sinks import Sink, SocketWriterSink
+from .util import dumps_picklable
+from .sources import Source, RawFile, get_fdsource
+from . import manager
+
+__all__ = ("ExportSink", "RemoteSource")
+
+SUBSCRIBE, UNSUBSCRIBE, UPDATES, UNSUBSCRIBED = range(4)
+
+_length = struct.Struct("!I")
+# struct ucred: pid, uid, gid
+_creds = struct.Struct("iII")
+# Anything bigger means the peer is confused.
+max_frame_size = 64 << 20
+
+class _PlainPickler(pickle.Pickler):
+    """ Only pickles builtin data: no instances, classes or functions """
+    def reducer_override(self, obj):
+        # Only called for what doesn't have an opcode of its own.
+        raise pickle.PicklingError("can't send %s objects" % type(obj).__name__)
+
+class _PlainUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError("refusing to load %s.%s" % (module, name))
+
+def _plain_dumps(obj):
+    f = io.BytesIO()
+    _PlainPickler(f, pickle.HIGHEST_PROTOCOL).dump(obj)
+    return f.getvalue()
+
+def _plain_loads(data):
+    return _PlainUnpickler(io.BytesIO(data)).load()
+
+def _prune(messages, picklable):
+    # Drop what can't be pickled rather than the whole batch.
+    kept = []
+    for op, arg in messages:
+        if op == UPDATES:
+            arg = {key: value for key, value in arg.items() if picklable((key, value))}
+        if picklable(arg):
+            kept.append((op, arg))
+    return kept
+
+def _dumps(messages, dumps=_plain_dumps):
+    return dumps_picklable(messages, _prune, dumps, report=True)
+
+def _frame(messages, dumps=_plain_dumps):
+    payload = _dumps(messages, dumps)
+    return _length.pack(len(payload)) + payload
+
+def _unframe(received, loads=_plain_loads):
+    """ Pop the messages of every complete frame off the received bytearray """
+    messages = []
+    offset = 0
+    while len(received) - offset >= _length.size:
+        (size,) = _length.unpack_from(received, offset)
+        if size > max_frame_size:
+            raise ValueError("frame too large: %d bytes" % size)
+        start = offset + _length.size
+        if len(received) - start < size:
+            break
+        messages.extend(loads(received[start:start + size]))
+        offset = start + size
+    del received[:offset]
+    return messages
+
+def _check_peer(sock):
+    """ Refuse to talk to processes running as another user """
+    import socket
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, _creds.size)
+    _, uid, _ = _creds.unpack(creds)
+    if uid != os.getuid():
+        raise PermissionError("peer runs as uid %d" % uid)
+
+class _Channel(SocketWriterSink):
+    """ One end of a connection: batches of (op, arg) messages """
+    coalesce_frames = False
+    # Merging would drop chunks read from the socket; send() batches.
+    coalesce_updates = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._messages = []
+        self._received = bytearray()
+
+    def send(self, op, arg):
+        messages = self._messages
+        if op == UPDATES:
+            if messages and messages[-1][0] == UPDATES:
+                messages[-1][1].update(arg)
+                return
+            arg = dict(arg)
+        messages.append((op, arg))
+        self._flush()
+
+    def _next_frame(self):
+        if not self._messages:
+            return None
+        messages, self._messages = self._messages, []
+        return _frame(messages)
+
+    def _start_with_target(self, f):
+        self._received = bytearray()
+        self.subscribe_to(RawFile(f), get_fdsource())
+        super()._start_with_target(f)
+
+    def _close_target(self):
+        f = self.target_file
+        if f is not None and RawFile(f) in self.subscriptions:
+            self.unsubscribe_from(RawFile(f), get_fdsource())
+        super()._close_target()
+
+    def _close_file(self, f):
+        # Only once the fd source has stopped reading from it.
+        get_fdsource().close_file(f)
+
+    def handle_updates(self, updates, source):
+        if source is not get_fdsource():
+            self.handle_source_updates(updates, source)
+            return
+        f = self.target_file
+        chunk = f is not None and updates.get(RawFile(f))
+        if not chunk:
+            return
+        self._received += chunk
+        try:
+            messages = _unframe(self._received)
+        except Exception as e:
+            self._close_target()
+            self.handle_lost_target(e)
+            return
+        for op, arg in messages:
+            self.handle_message(op, arg)
+
+    def handle_unsubscribe(self, subscription, source):
+        if source is not get_fdsource():
+            self.handle_source_unsubscribe(subscription, source)
+        elif subscription.file is self.target_file:
+            # The peer went away.
+            self._close_target()
+            self.handle_lost_target(None)
+
+    def handle_message(self, op, arg):
+        raise NotImplementedError()
+
+    def handle_source_updates(self, updates, source):
+        raise NotImplementedError()
+
+    def handle_source_unsubscribe(self, subscription, source):
+        raise NotImplementedError()
+
+class _ExportConnection(_Channel):
+    """ The subscriber standing in for one remote process """
+    retry_interval = None
+
+    def __init__(self, export, sock):
+        super().__init__()
+        self.export = export
+        self._sock = sock
+
+    def open_target(self):
+        sock, self._sock = self._sock, None
+        return sock
+
+    def handle_message(self, op, arg):
+        source = self.export.exported
+        if op == SUBSCRIBE:
+            if arg in self.subscriptions:
+                return
+            if source.is_publishing(arg):
+                self.subscribe_to(arg, source)
+            else:
+                self.send(UNSUBSCRIBED, arg)
+        elif op == UNSUBSCRIBE:
+            if arg in self.subscriptions:
+                self.unsubscribe_from(arg, source)
+
+    def handle_source_updates(self, updates, source):
+        subscriptions = self.subscriptions
+        if not all(key in subscriptions for key in updates):
+            updates = {k: v for k, v in updates.items() if k in subscriptions}
+        if updates:
+            self.send(UPDATES, updates)
+
+    def handle_source_unsubscribe(self, subscription, source):
+        self.send(UNSUBSCRIBED, subscription)
+
+    def stop(self):
+        if super().stop():
+            self.export.connections.discard(self)
+            return True
+        return False
+
+class ExportSink(Sink):
+    """ Exports source (the manager's Aggregator by default) on socket_path """
+    socket_path = None
+    source = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.connections = set()
+        self._listener = None
+
+    @property
+    def exported(self):
+        return self.source if self.source is not None else manager.aggregator
+
+    def start(self):
+        if super().start():
+            self._listen()
+            return True
+        return False
+
+    def _listen(self):
+        import socket
+        path = self.socket_path
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except OSError:
+                # Left behind by a dead process.
+                os.unlink(path)
+            else:
+                raise RuntimeError("%s is already exported" % path)
+            finally:
+                probe.close()
+        listener = socket.socket(
+            socket.AF_UNIX, socket.SOCK_STREAM | socket.SOCK_NONBLOCK | socket.SOCK_CLOEXEC
+        )
+        listener.bind(path)
+        os.chmod(path, 0o600)
+        listener.listen()
+        self._listener = listener
+        get_fdsource().call_when_readable(listener, ExportSink._accept, self, listener)
+
+    def _accept(self, listener):
+        if listener is not self._listener:
+            return
+        while True:
+            try:
+                sock, _ = listener.accept()
+            except BlockingIOError:
+                break
+            except OSError:
+                import traceback
+                traceback.print_exc()
+                break
+            try:
+                _check_peer(sock)
+            except OSError:
+                import traceback
+                traceback.print_exc()
+                sock.close()
+                continue
+            connection = _ExportConnection(self, sock)
+            self.connections.add(connection)
+            connection.start()
+        get_fdsource().call_when_readable(listener, ExportSink._accept, self, listener)
+
+    def stop(self):
+        if super().stop():
+            listener, self._listener = self._listener, None
+            if listener is not None:
+                get_fdsource().cancel_readable(listener)
+                listener.close()
+                try:
+                    os.unlink(self.socket_path)
+                except OSError:
+                    pass
+            for connection in tuple(self.connections):
+                connection.stop()
+            return True
+        return False
+
+class RemoteSource(_Channel, Source):
+    """
+    Publishes what the ExportSink on socket_path publishes.
+
+    Connects on the first subscription and reconnects (resubscribing)
+    every retry_interval seconds while the exporting process is gone. With
+    publishes left as None, every subscription is forwarded, so add this
+    source after the local ones.
+    """
+    publishes = None
+
+    def is_publishing(self, subscription):
+        if self.publishes is None:
+            return self._can_publish()
+        return super().is_publishing(subscription)
+
+    def open_target(self):
+        sock = super().open_target()
+        try:
+            _check_peer(sock)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def _start_with_target(self, f):
+        self._messages = [(SUBSCRIBE, subscription) for subscription in self.subscribers]
+        super()._start_with_target(f)
+
+    def on_subscribe(self, subscriber, subscription):
+        if len(self.subscribers[subscription]) == 1:
+            self.send(SUBSCRIBE, subscription)
+
+    def on_unsubscribe(self, subscriber, subscription):
+        if subscription not in self.subscribers:
+            self.send(UNSUBSCRIBE, subscription)
+
+    def handle_message(self, op, arg):
+        if op == UPDATES:
+            self.push_updates(arg)
+        elif op == UNSUBSCRIBED:
+            self.push_unsubscribe(arg)
+
+    def handle_source_updates(self, updates, source):
+        pass
+
+    def handle_source_unsubscribe(self, subscription, source):
+        pass
@@ -16,8 +16,11 @@
 ##
 
 from .base import Runnable, Subscriber, Subprocess
-from .sources import get_fdsource, get_fwsource, get_timersource
-import subprocess, pyinotify
+from .sources import RawFile, Lines, get_fdsource, get_fwsource, get_timersource
+import subprocess
+from . import inotify, manager
+from threading import Thread
+import collections
 import stat, os
 
 class Sink(Runnable, Subscriber):
@@ -29,6 +32,7 @@ class Sink(Runnable, Subscriber):
             for source in sources:
                 source.unsubscribe(self, subscription)
         self.subscriptions = {}
+        self._cancel_throttled()
         return super().stop(*args, **kwargs)
 
 class SimpleSink(Sink):
@@ -47,24 +51,44 @@ class SimpleSink(Sink):
         raise NotImplementedError()
 
 class ReaderSink(Sink):
+    # Only handle the last line of every chunk read (and let the manager
+    # merge pending chunks) instead of handling every line.
+    latest_only = False
+    # Receive the raw bytes read from the file in handle_input_bytes instead
+    # of decoded lines in handle_input.
+    binary = False
+
+    @property
+    def coalesce_updates(self):
+        return self.latest_only and not self.binary
 
     def _start_with_source(self, source):
-        self.source_file = source
-        self.subscribe_to(source, get_fdsource())
+        self.source_file = RawFile(source) if self.binary else Lines(source)
+        self.subscribe_to(self.source_file, get_fdsource())
 
     def handle_unsubscribe(self, subscription, source):
         self.stop()
 
     def handle_updates(self, updates, source):
-        try:
-            line = updates[self.source_file]
-        except KeyError:
-            return
-        self.handle_input(line)
+        # Not just source_file: a restarted PipeSink still reads what the
+        # previous process wrote.
+        for subscription, data in updates.items():
+            if subscription not in self.subscriptions:
+                continue
+            if self.binary:
+                self.handle_input_bytes(data)
+            elif self.latest_only:
+                self.handle_input(data[-1])
+            else:
+                for line in data:
+                    self.handle_input(line)
 
     def handle_input(self, line):
         raise NotImplementedError()
 
+    def handle_input_bytes(self, data):
+        raise NotImplementedError()
+
 class FifoSink(ReaderSink):
     fifo_path = None
     create = False
@@ -112,9 +136,16 @@ class PipeSink(Subprocess, ReaderSink):
     stdout = subprocess.PIPE
 
     def handle_unsubscribe(self, subscription, source):
-        # Restart on crash
-        if not self._maybe_restart():
+        # Hit EOF. When restarting on exit, the process is restarted (or
+        # this sink stopped) once the child reaper sees it exit.
+        if subscription == self.source_file and (self._gave_up or not self._restarts_on_exit()):
             super().handle_unsubscribe(subscription, source)
+
+    def _give_up(self):
+        # Stop once everything the process wrote has been read.
+        self._gave_up = True
+        if self.source_file not in self.subscriptions:
+            self.stop()
     
     def _start_subprocess(self):
         if super()._start_subprocess():
@@ -122,8 +153,218 @@ class PipeSink(Subprocess, ReaderSink):
             return True
         return False
 
+class WriterSink(Sink):
+    """
+    Writes frames (str or bytes, e.g. one status line each) to a pipe,
+    FIFO, socket etc. without ever blocking the manager.
+
+    write_frame() writes what it can right away; the rest is written once
+    the FDManagerSource sees the file is writable again. Frames are always
+    written whole and in order but, with coalesce_frames, a new frame
+    replaces any frame still waiting to be written so a slow consumer only
+    gets the newest one. Call write_frame() from the manager (e.g. from
+    handle_updates).
+
+    Writes go to output_file (which is made non-blocking but never closed)
+    or to whatever open_target() returns. If that fails, or the consumer
+    goes away, the target is opened again every retry_interval seconds (or
+    the sink stops if that's None).
+    """
+    output_file = None
+    coalesce_frames = True
+    encoding = "utf-8"
+    # Without coalesce_frames, drop the oldest waiting frames beyond this
+    # many bytes.
+    max_buffer = 1 << 20
+    retry_interval = None
+
+    target_file = None
+    _retry_timer = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.frames_dropped = 0
+        self._waiting = collections.deque()
+        self._waiting_size = 0
+        # Unwritten part of the frame being written.
+        self._current = None
+        self._last = None
+        self._polling = False
+
+    def start(self):
+        if super().start():
+            self._connect()
+            return True
+        return False
+
+    def open_target(self):
+        """ Open the file to write to; return None to wait, raise OSError to retry """
+        return self.output_file
+
+    def _connect(self):
+        self._retry_timer = None
+        if not self.running or self.target_file is not None:
+            return
+        try:
+            f = self.open_target()
+        except OSError as e:
+            self.handle_lost_target(e)
+            return
+        if f is not None:
+            self._start_with_target(f)
+
+    def _start_with_target(self, f):
+        self._close_target()
+        os.set_blocking(f.fileno(), False)
+        self.target_file = f
+        if self.coalesce_frames and not self._waiting and self._last is not None:
+            # Bring the new consumer up to date.
+            self._waiting.append(self._last)
+            self._waiting_size = len(self._last)
+        self._flush()
+
+    def _close_target(self):
+        f, self.target_file = self.target_file, None
+        self._current = None
+        if f is None:
+            return
+        if self._polling:
+            get_fdsource().cancel_writable(f)
+            self._polling = False
+        if f is not self.output_file:
+            self._close_file(f)
+
+    def _close_file(self, f):
+        try:
+            f.close()
+        except OSError:
+            pass
+
+    def write_frame(self, frame):
+        if isinstance(frame, str):
+            frame = frame.encode(self.encoding)
+        self._last = frame
+        if self._waiting and self.coalesce_frames:
+            self.frames_dropped += len(self._waiting)
+            self._waiting.clear()
+            self._waiting_size = 0
+        self._waiting.append(frame)
+        self._waiting_size += len(frame)
+        while self._waiting_size > self.max_buffer and len(self._waiting) > 1:
+            self._waiting_size -= len(self._waiting.popleft())
+            self.frames_dropped += 1
+        self._flush()
+
+    def _flush(self):
+        f = self.target_file
+        if f is None or self._polling:
+            return
+        while True:
+            if not self._current:
+                if self._waiting:
+                    frame = self._waiting.popleft()
+                    self._waiting_size -= len(frame)
+                else:
+                    frame = self._next_frame()
+                    if frame is None:
+                        return
+                self._current = memoryview(frame)
+            try:
+                written = os.write(f.fileno(), self._current)
+            except BlockingIOError:
+                self._polling = True
+                get_fdsource().call_when_writable(f, WriterSink._writable, self, f)
+                return
+            except OSError as e:
+                self._close_target()
+                self.handle_lost_target(e)
+                return
+            self._current = self._current[written:]
+
+    def _next_frame(self):
+        # Lets subclasses build a frame from whatever piled up while the
+        # target wasn't writable, once it is.
+        return None
+
+    def _writable(self, f):
+        if f is self.target_file and self._polling:
+            self._polling = False
+            self._flush()
+
+    def handle_lost_target(self, error):
+        """ Called when the target couldn't be opened or written to """
+        if self.retry_interval is None:
+            self.stop()
+        elif self.running and self._retry_timer is None:
+            self._retry_timer = get_timersource().call_later(
+                self.retry_interval, WriterSink._connect, self
+            )
+
+    def stop(self):
+        if super().stop():
+            if self._retry_timer is not None:
+                self._retry_timer.cancel()
+                self._retry_timer = None
+            self._close_target()
+            self._waiting.clear()
+            self._waiting_size = 0
+            return True
+        return False
+
+class FifoWriterSink(WriterSink):
+    """ Writes to a FIFO, waiting for (and outliving) its readers """
+    fifo_path = None
+    create = False
+    retry_interval = 1
+
+    def open_target(self):
+        if self.create and not os.path.exists(self.fifo_path):
+            os.mkfifo(self.fifo_path)
+        # Fails (ENXIO) rather than blocks while nobody is reading.
+        fd = os.open(self.fifo_path, os.O_WRONLY | os.O_NONBLOCK | os.O_CLOEXEC)
+        return open(fd, "wb", buffering=0)
+
+class SocketWriterSink(WriterSink):
+    """ Writes to a (stream) Unix domain socket, reconnecting as needed """
+    socket_path = None
+    retry_interval = 1
+
+    def open_target(self):
+        import socket
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM | socket.SOCK_CLOEXEC)
+        try:
+            sock.setblocking(False)
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+class ProcessWriterSink(Subprocess, WriterSink):
+    """ Writes to the stdin of a (restarted) process """
+    stdin = subprocess.PIPE
+    restart_on_exit = True
+
+    def open_target(self):
+        # Set when the process is (re)started.
+        return None
+
+    def _start_subprocess(self):
+        if super()._start_subprocess():
+            self._start_with_target(self.proc.stdin)
+            return True
+        return False
+
+    def handle_lost_target(self, error):
+        # When restarting on exit, the child reaper starts a new process.
+        if not self._restarts_on_exit():
+            self.stop()
+
 class InotifySink(Sink):
     watches = []
+    # Every batch of events must be handled: merging (or dropping) pending
+    # batches would lose events without a resync().
+    coalesce_updates = False
 
     def handle_unsubscribe(self, subscription, source):
         self.stop()
@@ -139,59 +380,188 @@ class InotifySink(Sink):
         self.subscribe_to(frozenset(args.items()), get_fwsource())
     
     def handle_updates(self, updates, source):
-        for sub, event in updates.items():
+        for sub, events in updates.items():
             if sub not in self.subscriptions:
                 continue
-            self.file_changed(event)
+            for event in events:
+                if event.mask & (inotify.IN_Q_OVERFLOW | inotify.IN_IGNORED):
+                    self.resync(event)
+                else:
+                    self.file_changed(event)
 
-    def file_changed(self, path, mask):
+    def file_changed(self, event):
         raise NotImplementedError()
 
+    def resync(self, event):
+        """
+        Called when events may have been missed: the kernel's event queue
+        overflowed or a watch was removed (e.g. the directory was deleted).
+        """
+        pass
+
 class FilecountSink(InotifySink):
-        add_events = pyinotify.IN_MOVED_TO | pyinotify.IN_CREATE
-        remove_events = pyinotify.IN_MOVED_FROM | pyinotify.IN_DELETE
-        watchdirs = []
-        _count = None
-
-        def start(self):
-            if not self.watches:
-                all_events = self.add_events | self.remove_events
-                self.watches = [{"path": wdir, "mask": all_events} for wdir in self.watchdirs]
-            # Initialize Count
-            # Asking for it initializes and sends it
-            self.count
-            return super().start()
-
-        def matches(self, path):
+    """
+    Counts the (matching) files in watchdirs.
+
+    The directories are scanned in a background thread on start and the
+    count is then maintained from inotify events; count_changed() is first
+    called once every directory has been scanned. With recursive set,
+    files in subdirectories are counted too (directories themselves are
+    not). Directories are rescanned whenever events may have been missed.
+    Note that matches() is also called from the scanning thread.
+    """
+    add_events = inotify.IN_MOVED_TO | inotify.IN_CREATE
+    remove_events = inotify.IN_MOVED_FROM | inotify.IN_DELETE
+    watchdirs = []
+    recursive = False
+    _count = None
+    _ready = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # directory -> names of the matching entries
+        self._entries = {}
+        # directory -> (token, journal of events) for running scans
+        self._scans = {}
+
+    def start(self):
+        if not self.watches:
+            all_events = self.add_events | self.remove_events
+            self.watches = [{
+                "path": wdir,
+                "mask": all_events,
+                "rec": self.recursive,
+                "auto_add": self.recursive,
+            } for wdir in self.watchdirs]
+        if super().start():
+            # Scan once the watches are in place so no change is missed.
+            get_fwsource().call_when_watching(self._scan_all)
             return True
+        return False
 
-        @property
-        def count(self):
-            if self._count is None:
-                self.count = sum(sum(
-                    1 for f in os.listdir(mdir)
-                    if self.matches(os.path.join(mdir, f))
-                ) for mdir in self.watchdirs)
-            return self._count
-
-        @count.setter
-        def count(self, value):
-            if (self._count != value):
-                self._count = value
-                self.count_changed(self._count)
-
-        def file_changed(self, event):
-            if not self.matches(event.pathname):
-                return
-            if event.mask & self.add_events:
-                self.count += 1
-            elif event.mask & self.remove_events:
-                self.count -= 1
-            else:
-                return
+    @manager.queued
+    def _scan_all(self):
+        if self.running:
+            self._ready = True
+            for wdir in self.watchdirs:
+                self._rescan(wdir)
+            self._update_count()
+
+    def matches(self, path):
+        return True
+
+    @property
+    def count(self):
+        return self._count
+
+    def _covers(self, top, path):
+        return path == top or self.recursive and path.startswith(top.rstrip('/') + '/')
+
+    def _journals_of(self, path):
+        return [journal for top, (_, journal) in self._scans.items()
+                if self._covers(top, path)]
+
+    def _rescan(self, top):
+        token = object()
+        self._scans[top] = (token, [])
+        Thread(target=self._scan, args=(top, token), daemon=True).start()
+
+    def _drop(self, top):
+        for path in tuple(self._entries):
+            if self._covers(top, path):
+                del self._entries[path]
+
+    def _scan(self, top, token):
+        check = type(self).matches is not FilecountSink.matches
+        entries = {}
+        pending = [top]
+        while pending:
+            path = pending.pop()
+            names = set()
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if self.recursive and entry.is_dir(follow_symlinks=False):
+                            pending.append(entry.path)
+                        elif not check or self.matches(entry.path):
+                            names.add(entry.name)
+            except OSError:
+                if path != top:
+                    continue
+            entries[path] = names
+        self._scanned(top, token, entries)
+
+    @manager.queued
+    def _scanned(self, top, token, entries):
+        try:
+            current, journal = self._scans[top]
+        except KeyError:
+            return
+        if current is not token:
+            return
+        del self._scans[top]
+        self._drop(top)
+        self._entries.update(entries)
+        # Events are idempotent on the name sets, so replaying everything
+        # that happened during the scan fixes up whatever it missed.
+        for event in journal:
+            self._apply(event)
+        self._update_count()
+
+    def _update_count(self):
+        if self._count is None and (self._scans or not self._ready):
+            # Still scanning for the initial count.
+            return
+        count = sum(len(names) for names in self._entries.values())
+        if count != self._count:
+            self._count = count
+            self.count_changed(count)
+
+    def file_changed(self, event):
+        journals = self._journals_of(event.path)
+        if journals:
+            for journal in journals:
+                journal.append(event)
+        else:
+            self._apply(event)
+            self._update_count()
+
+    def _apply(self, event):
+        if self.recursive and event.dir:
+            if event.mask & self.remove_events:
+                self._drop(event.pathname)
+            elif event.mask & self.add_events:
+                # The watch on a new directory is only added once the
+                # source sees its creation; count what's already inside.
+                self._rescan(event.pathname)
+            return
+        names = self._entries.get(event.path)
+        if names is None or not self.matches(event.pathname):
+            return
+        if event.mask & self.add_events:
+            names.add(event.name)
+        elif event.mask & self.remove_events:
+            names.discard(event.name)
+
+    def resync(self, event):
+        if event.mask & inotify.IN_Q_OVERFLOW:
+            self._scan_all.__wrapped__(self)
+        elif os.path.isdir(event.path):
+            self._rescan(event.path)
+        else:
+            # Gone; nothing left to count.
+            self._drop(event.path)
+            self._update_count()
 
-        def count_changed(self, count):
-            raise NotImplementedError()
+    def stop(self, *args, **kwargs):
+        self._scans = {}
+        self._entries = {}
+        self._count = None
+        self._ready = False
+        return super().stop(*args, **kwargs)
+
+    def count_changed(self, count):
+        raise NotImplementedError()
 
 class TimerSink(Sink):
     MIN_INTERVAL = None
@@ -15,17 +15,25 @@
 #    along with Overkill.  If not, see <http://www.gnu.org/licenses/>.
 ##
 
-from threading import Thread, Event
-from .base import Runnable, Publisher
-import select, os
+from threading import Thread, Event, Lock, current_thread
+from .base import Runnable, Publisher, Subscriber
+from . import inotify
+import selectors, os
+import codecs
 import fcntl
 import time
-import pyinotify
+import heapq
+import glob
 from . import manager
 
-__all__=("Source", "ThreadedSource", "get_timersource", "get_fdsource", "get_fwsource")
+__all__=("Source", "ThreadedSource", "AsyncSource", "RawFile", "Lines", "get_timersource", "get_fdsource", "get_fwsource", "get_childsource")
 
 class Source(Runnable, Publisher):
+    # Counts subscribe() calls: a stop check queued before a subscription
+    # was requested must not stop the source before the subscription is
+    # made.
+    _subscribes = 0
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
@@ -35,47 +43,114 @@ class Source(Runnable, Publisher):
         return super().stop(*args, **kwargs)
 
     def subscribe(self, *args, **kwargs):
+        self._subscribes += 1
         self.start()
         super().subscribe(*args, **kwargs)
 
     def unsubscribe(self, *args, **kwargs):
         super().unsubscribe(*args, **kwargs)
+        self._queue_stop_check()
+
+    def push_unsubscribe(self, subscription):
+        super().push_unsubscribe(subscription)
+        self._queue_stop_check()
+
+    def _queue_stop_check(self):
+        # Queue on the source itself so that the check runs in order with
+        # this source's other queued calls.
+        manager.queue(type(self)._stop_if_unused, (self, self._subscribes))
+
+    def _stop_if_unused(self, subscribes):
         # Don't need to lock because stop will lock and check
         # running again.
-        def later():
-            if not self.subscribers and self.running:
-                self.stop()
-        manager.queue(later)
+        if not self.subscribers and self.running and subscribes == self._subscribes:
+            self.stop()
 
 class InterruptableWaiter:
+    """
+    Waits for registered files to become readable.
+
+    Files are registered once with an epoll (or equivalent) selector so the
+    cost of a wakeup depends on the number of ready files, not the number of
+    watched ones. interrupt() wakes a waiting select() through an eventfd.
+    """
     def __init__(self):
-        self._interrupt_read_fd, self._interrupt_write_fd = os.pipe()
+        self._selector = selectors.DefaultSelector()
+        if hasattr(os, "eventfd"):
+            self._interrupt_read_fd = self._interrupt_write_fd = \
+                    os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        else:
+            self._interrupt_read_fd, self._interrupt_write_fd = os.pipe()
+            os.set_blocking(self._interrupt_read_fd, False)
+        self._selector.register(self._interrupt_read_fd, selectors.EVENT_READ)
         self._is_set = False
 
+    def register(self, f, events=selectors.EVENT_READ):
+        try:
+            self._selector.register(f, events)
+        except KeyError:
+            # Already registered (maybe for other events)
+            key = self._selector.get_key(f)
+            if key.events | events != key.events:
+                self._selector.modify(f, key.events | events)
+
+    def unregister(self, f, events=selectors.EVENT_READ):
+        try:
+            key = self._selector.get_key(f)
+        except (KeyError, ValueError):
+            return
+        if key.events & ~events:
+            self._selector.modify(f, key.events & ~events)
+        else:
+            self._selector.unregister(f)
+
     def interrupt(self):
         if self._is_set:
             return
         self._is_set = True # Prevent repeats (Yay GIL...)
-        os.write(self._interrupt_write_fd, bytes(1))
-
+        if self._interrupt_read_fd == self._interrupt_write_fd:
+            os.eventfd_write(self._interrupt_write_fd, 1)
+        else:
+            os.write(self._interrupt_write_fd, bytes(1))
 
-    def select(self, files):
-        w, _, _ = select.select(list(files) + [self._interrupt_read_fd], [], [])
+    def _clear(self):
         try:
-            w.remove(self._interrupt_read_fd)
-            os.read(self._interrupt_read_fd, 1)
-            self._is_set = False
-        except ValueError:
+            if self._interrupt_read_fd == self._interrupt_write_fd:
+                os.eventfd_read(self._interrupt_read_fd)
+            else:
+                os.read(self._interrupt_read_fd, 1)
+        except BlockingIOError:
             pass
-        return w
+        self._is_set = False
+
+    def poll(self, timeout=None):
+        """ Wait for registered files; returns [(key, ready events), ...] """
+        ready = []
+        for key, events in self._selector.select(timeout):
+            if key.fd == self._interrupt_read_fd:
+                self._clear()
+            else:
+                ready.append((key, events))
+        return ready
+
+    def select(self, timeout=None):
+        return [
+            key.fileobj for key, events in self.poll(timeout)
+            if events & selectors.EVENT_READ
+        ]
+
+class ThreadedSource(Source):
+    """ A source whose run() loop gets a (new) thread every time it starts """
+    _thread = None
 
-class ThreadedSource(Source, Thread):
     def __init__(self):
         super().__init__()
 
     def start(self):
         if Source.start(self):
-            Thread.start(self)
+            self._thread = Thread(target=self.run, daemon=True,
+                                  name=self.__class__.__name__)
+            self._thread.start()
             return True
         return False
 
@@ -84,12 +159,107 @@ class ThreadedSource(Source, Thread):
 
     def stop(self):
         ret = super().stop()
-        self.join()
+        if ret and self._thread is not current_thread():
+            self._thread.join()
         return ret
 
+    # The parts of the Thread API subclasses used back when this was one.
+    @property
+    def name(self):
+        return self.__class__.__name__ if self._thread is None else self._thread.name
+
+    @property
+    def ident(self):
+        return None if self._thread is None else self._thread.ident
+
+    @property
+    def daemon(self):
+        return True
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+class AsyncSource(Source):
+    """
+    A source whose run() is a coroutine.
+
+    With the asyncio manager backend it runs on the manager's event loop,
+    otherwise it gets a private loop on its own thread.
+    """
+    _task = None
+
+    def start(self):
+        if Source.start(self):
+            self._task = manager.spawn(self.run())
+            return True
+        return False
+
+    async def run(self):
+        raise NotImplementedError()
+
+    def stop(self):
+        ret = super().stop()
+        if ret and self._task is not None:
+            self._task.cancel()
+            self._task = None
+        return ret
+
+class RawFile:
+    """
+    Subscribe to the raw bytes read from a file, without decoding or
+    splitting them into lines (see FDManagerSource).
+    """
+    __slots__ = ("file",)
+
+    def __init__(self, file):
+        self.file = file
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def __eq__(self, other):
+        return type(other) is type(self) and other.file == self.file
+
+    def __hash__(self):
+        return hash((type(self), self.file))
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.file)
+
+class Lines(RawFile):
+    """
+    Subscribe to the lines read from a file a chunk at a time, as a list
+    (see FDManagerSource).
+    """
+    __slots__ = ()
+
 class FDManagerSource(ThreadedSource):
+    """
+    Publishes data read from files.
+
+    Subscribing to a file publishes {file: line} once per line (newline
+    stripped). Subscribing to Lines(file) instead publishes
+    {Lines(file): [line, ...]} with every complete line of a chunk once per
+    read; subscribers only interested in the latest value can just take the
+    last one. Subscribing to RawFile(file) publishes {RawFile(file): chunk}
+    with the bytes as read.
+
+    call_when_writable(file, fn, *args) queues fn(*args) on the manager once
+    file can be written to without blocking (see WriterSink);
+    call_when_readable() does the same for reading from (or accepting on) a
+    file that isn't subscribed to.
+    """
+    chunk_size = 65536
+
     def __init__(self):
-        self.__fd_map = {}
+        self._readers = {}
+        self._lock = Lock()
+        # (fd, event) -> (fn, args)
+        self._callbacks = {}
         self._waiter = InterruptableWaiter()
         super().__init__()
 
@@ -98,47 +268,319 @@ class FDManagerSource(ThreadedSource):
 
     def run(self):
         while self.running:
-            for f in self._waiter.select(self.subscribers.keys()):
-                if not f.peek():
-                    # EOF
-                    self.push_unsubscribe(f)
+            if manager.backpressured:
+                # Leave the data in the kernel's buffers until the manager
+                # catches up.
+                manager.wait_for_space(0.1)
+                continue
+            for key, events in self._waiter.poll():
+                f = key.fileobj
+                if events & selectors.EVENT_WRITE:
+                    self._ready(key, selectors.EVENT_WRITE)
+                if not events & selectors.EVENT_READ \
+                        or self._ready(key, selectors.EVENT_READ):
                     continue
                 try:
-                    while b'\n' in f.peek():
-                        line = f.readline()
-
-                        if not isinstance(line, str):
-                            line = line.decode('utf-8')
-
-                        self.push_updates({f: line.rstrip('\n')})
+                    updates, lines, eof = self._read(f)
                 except:
+                    updates, lines, eof = None, None, True
+                if updates:
+                    self.push_updates(updates)
+                if lines and f in self.subscribers:
+                    for line in lines:
+                        self.push_updates({f: line})
+                if eof:
+                    self._waiter.unregister(f)
+                    self._readers.pop(f, None)
                     self.push_unsubscribe(f)
+                    self.push_unsubscribe(Lines(f))
+                    self.push_unsubscribe(RawFile(f))
         self.running = False
 
+    def _read(self, f):
+        try:
+            chunk = os.read(f.fileno(), self.chunk_size)
+        except BlockingIOError:
+            return None, None, False
+        eof = not chunk
+        updates = {}
+        lines = None
+        if chunk:
+            raw = RawFile(f)
+            if raw in self.subscribers:
+                # Hand out the bytes object as read; no decoding or copying.
+                updates[raw] = chunk
+        key = Lines(f)
+        if f in self.subscribers or key in self.subscribers:
+            lines = self._split_lines(f, chunk, eof)
+            if lines and key in self.subscribers:
+                updates[key] = lines
+        return updates, lines, eof
+
+    def _split_lines(self, f, chunk, eof):
+        try:
+            decoder, partial = self._readers[f]
+        except KeyError:
+            encoding = getattr(f, "encoding", None) or "utf-8"
+            decoder = codecs.getincrementaldecoder(encoding)("replace")
+            partial = ""
+        lines = (partial + decoder.decode(chunk, eof)).split('\n')
+        partial = lines.pop()
+        if eof:
+            if partial:
+                lines.append(partial)
+        else:
+            self._readers[f] = (decoder, partial)
+        return lines
+
+    def call_when_writable(self, f, fn, *args):
+        """
+        Queue fn(*args) on the manager (once) as soon as f is writable.
+        Replaces any callback already waiting on f.
+        """
+        self._call_when(f, selectors.EVENT_WRITE, fn, args)
+
+    def call_when_readable(self, f, fn, *args):
+        """ Like call_when_writable, for files that aren't subscribed to """
+        self._call_when(f, selectors.EVENT_READ, fn, args)
+
+    def cancel_writable(self, f):
+        """ Forget the callback waiting on f (call before closing f) """
+        self._cancel(f, selectors.EVENT_WRITE)
+
+    def cancel_readable(self, f):
+        self._cancel(f, selectors.EVENT_READ)
+
+    @manager.queued
+    def close_file(self, f):
+        """
+        Close f after the calls already queued on this source (e.g. an
+        unsubscribe from f) have run.
+        """
+        self._waiter.unregister(f, selectors.EVENT_READ | selectors.EVENT_WRITE)
+        try:
+            f.close()
+        except OSError:
+            pass
+
+    def _call_when(self, f, event, fn, args):
+        with self._lock:
+            self._callbacks[(f.fileno(), event)] = (fn, args)
+        self.start()
+        self._waiter.register(f, event)
+
+    def _cancel(self, f, event):
+        with self._lock:
+            self._callbacks.pop((f.fileno(), event), None)
+        self._waiter.unregister(f, event)
+
+    def _ready(self, key, event):
+        with self._lock:
+            callback = self._callbacks.pop((key.fd, event), None)
+        if callback is None:
+            if event == selectors.EVENT_WRITE:
+                self._waiter.unregister(key.fileobj, event)
+            return False
+        self._waiter.unregister(key.fileobj, event)
+        manager.queue(*callback)
+        return True
+
+    def _stop_if_unused(self, subscribes):
+        if not self._callbacks:
+            super()._stop_if_unused(subscribes)
+
     def on_stop(self):
         self._interrupt()
 
     def on_subscribe(self, subscriber, subscription):
-        flags = fcntl.fcntl(subscription.fileno(), fcntl.F_GETFD)
+        flags = fcntl.fcntl(subscription.fileno(), fcntl.F_GETFL)
         fcntl.fcntl(subscription.fileno(), fcntl.F_SETFL, flags | os.O_NONBLOCK)
-        self._interrupt()
+        # The selector picks up new registrations without a wakeup.
+        self._waiter.register(self._file(subscription))
+
+    def on_unsubscribe(self, subscriber, subscription):
+        f = self._file(subscription)
+        if f not in self.subscribers and Lines(f) not in self.subscribers:
+            self._readers.pop(f, None)
+            if RawFile(f) not in self.subscribers:
+                self._waiter.unregister(f)
+
+    @staticmethod
+    def _file(subscription):
+        # RawFile or Lines
+        if isinstance(subscription, RawFile):
+            return subscription.file
+        return subscription
 
     def _interrupt(self):
         self._waiter.interrupt()
 
-class FWManagerSource(Source, pyinotify.ProcessEvent):
+class ChildSource(ThreadedSource):
+    """
+    Reaps child processes (subprocess.Popen objects) from one thread.
+
+    watch(proc, fn, *args) queues fn(*args) on the manager once proc has
+    exited and been reaped. Exits are noticed through pidfds where the
+    platform supports them and by polling every poll_interval seconds
+    otherwise.
+    """
+    poll_interval = 1
+
     def __init__(self):
+        self._lock = Lock()
+        # proc -> (pidfd or None, fn, args)
+        self._children = {}
+        self._waiter = InterruptableWaiter()
         super().__init__()
-        self.watches = {}
-        self.watches_reverse = {}
-        self.wm = pyinotify.WatchManager()
-        self.notifier = pyinotify.ThreadedNotifier(self.wm, self)
+
+    def watch(self, proc, fn, *args):
+        pidfd = None
+        if hasattr(os, "pidfd_open"):
+            try:
+                pidfd = os.pidfd_open(proc.pid)
+            except OSError:
+                # Already reaped or no kernel support; poll.
+                pass
+        with self._lock:
+            self._children[proc] = (pidfd, fn, args)
+        self.start()
+        if pidfd is not None:
+            self._waiter.register(pidfd)
+        else:
+            self._waiter.interrupt()
+
+    def unwatch(self, proc):
+        with self._lock:
+            try:
+                pidfd, _, _ = self._children.pop(proc)
+            except KeyError:
+                return
+        self._close(pidfd)
+
+    def _close(self, pidfd):
+        if pidfd is not None:
+            self._waiter.unregister(pidfd)
+            os.close(pidfd)
+
+    def run(self):
+        while self.running and self._thread is current_thread():
+            with self._lock:
+                polling = any(pidfd is None for pidfd, _, _ in self._children.values())
+            ready = self._waiter.select(self.poll_interval if polling else None)
+            with self._lock:
+                exited = [
+                    proc for proc, (pidfd, _, _) in self._children.items()
+                    if pidfd is None or pidfd in ready
+                ]
+            for proc in exited:
+                if proc.poll() is None:
+                    continue
+                with self._lock:
+                    try:
+                        pidfd, fn, args = self._children.pop(proc)
+                    except KeyError:
+                        continue
+                self._close(pidfd)
+                manager.queue(fn, args)
+
+    def on_stop(self):
+        self._waiter.interrupt()
+
+    def _stop_if_unused(self, subscribes):
+        if not self._children:
+            super()._stop_if_unused(subscribes)
+
+    def is_publishing(self, subscription):
+        return False
+
+class InotifyWatch:
+    """ One watched path (or glob) shared by every subscription on it """
+    def __init__(self, path, options):
+        self.path = path
+        self.options = options
+        # subscription -> (mask, rec, auto_add)
+        self.subscriptions = {}
+        self.roots = set()
+        self.dirs = set()
+        self.mask = 0
+        self.rec = False
+        self.auto_add = False
+
+    def wants(self, subscription, path, event):
+        mask, rec, auto_add = self.subscriptions[subscription]
+        return event.mask & mask and (rec or auto_add or path in self.roots)
+
+class FWManagerSource(Source, Subscriber):
+    """
+    Publishes inotify events.
+
+    Subscriptions are frozensets of watch arguments: path, mask and
+    optionally rec, auto_add, do_glob and exclude_filter (as for pyinotify's
+    WatchManager.add_watch()). Subscriptions on the same path share kernel
+    watches (with the union of their masks) and events are filtered per
+    subscription. The events of each read are published together as
+    {subscription: [event, ...]} (see overkill.inotify.Event).
+    IN_Q_OVERFLOW events are sent to every subscription and IN_IGNORED
+    events (the watch was lost) to every subscription on that path, so
+    subscribers can resynchronize.
+
+    The inotify file descriptor is read by the FDManagerSource; events are
+    parsed on the dispatch thread.
+    """
+    subscription_types = (frozenset,)
+    # Every chunk read must be handled.
+    coalesce_updates = False
+
+    def __init__(self):
+        super().__init__()
+        self._inotify = os.fdopen(inotify.init(), "rb", buffering=0)
+        self._watches = {}
+        # Kernel watches: directory -> wd, wd -> directory and
+        # directory -> InotifyWatches covering it.
+        self._wds = {}
+        self._paths = {}
+        self._dir_watches = {}
 
     def on_start(self):
-        self.notifier.start()
+        self.subscribe_to(RawFile(self._inotify), get_fdsource())
+
+    def handle_unsubscribe(self, subscription, source):
+        # The fd source stopped reading the inotify fd (a read error). Start
+        # over with a new one and, since events may have been lost, send
+        # every subscription an overflow event so subscribers resynchronize.
+        if subscription != RawFile(self._inotify) or not self.running:
+            return
+        lost, self._inotify = self._inotify, os.fdopen(inotify.init(), "rb", buffering=0)
+        source.close_file(lost)
+        self._wds = {}
+        self._paths = {}
+        for path in tuple(self._dir_watches):
+            if not self._sync_dir(path):
+                self._drop_dir(path)
+        self.subscribe_to(RawFile(self._inotify), source)
+        overflow = inotify.Event(-1, inotify.IN_Q_OVERFLOW, 0, "", None)
+        batch = {
+            subscription: [overflow]
+            for watch in self._watches.values()
+            for subscription in watch.subscriptions
+        }
+        if batch:
+            self.push_updates(batch)
 
     def on_stop(self):
-        self.notifier.stop()
+        raw = RawFile(self._inotify)
+        if raw in self.subscriptions:
+            self.unsubscribe_from(raw, get_fdsource())
+        # Source.stop() dropped every subscription.
+        for wd in self._paths:
+            try:
+                inotify.rm_watch(self._inotify.fileno(), wd)
+            except OSError:
+                pass
+        self._watches = {}
+        self._wds = {}
+        self._paths = {}
+        self._dir_watches = {}
 
     def is_publishing(self, subscription):
         sub = dict(subscription)
@@ -148,77 +590,367 @@ class FWManagerSource(Source, pyinotify.ProcessEvent):
         except:
             return False
 
+    @staticmethod
+    def _split(subscription):
+        options = dict(subscription)
+        paths = options.pop('path')
+        if isinstance(paths, str):
+            paths = (paths,)
+        mask = options.pop('mask')
+        rec = options.pop('rec', False)
+        auto_add = options.pop('auto_add', False)
+        return paths, (mask, rec, auto_add), frozenset(options.items())
+
     def on_subscribe(self, subscriber, subscription):
-        wdd = self.wm.add_watch(**dict(subscription))
-        for wd in wdd.values():
-            self.watches[wd] = (subscriber, subscription)
-        self.watches_reverse[(subscriber, subscription)] = wdd
+        if len(self.subscribers[subscription]) > 1:
+            # Already watching for another subscriber.
+            return
+        paths, params, options = self._split(subscription)
+        for path in paths:
+            watch = self._watches.get((path, options))
+            if watch is None:
+                watch = self._watches[(path, options)] = InotifyWatch(path, options)
+            watch.subscriptions[subscription] = params
+            self._update_watch(watch)
 
     def on_unsubscribe(self, subscriber, subscription):
-        wdd = self.watches_reverse.pop((subscriber, subscription))
-        for wd in wdd.values():
-            del self.watches[wd]
-            self.wm.del_watch(wd)
-
-    def process_default(self, event):
+        if subscription in self.subscribers:
+            return
+        paths, _, options = self._split(subscription)
+        for path in paths:
+            watch = self._watches.get((path, options))
+            if watch is None:
+                continue
+            watch.subscriptions.pop(subscription, None)
+            if not watch.subscriptions:
+                del self._watches[(path, options)]
+            self._update_watch(watch)
+
+    def _update_watch(self, watch):
+        mask = 0
+        rec = auto_add = False
+        for sub_mask, sub_rec, sub_auto_add in watch.subscriptions.values():
+            mask |= sub_mask
+            rec |= sub_rec
+            auto_add |= sub_auto_add
+        if auto_add:
+            mask |= inotify.IN_CREATE
+        if not watch.subscriptions:
+            dirs = set()
+        elif watch.dirs and rec == watch.rec and auto_add == watch.auto_add:
+            dirs = watch.dirs
+        else:
+            options = dict(watch.options)
+            if options.get('do_glob'):
+                watch.roots = set(glob.glob(watch.path))
+            else:
+                watch.roots = {watch.path}
+            dirs = set()
+            for root in watch.roots:
+                dirs.update(self._walk(watch, root, rec))
+        old_mask = watch.mask
+        watch.mask, watch.rec, watch.auto_add = mask, rec, auto_add
+        for path in watch.dirs - dirs:
+            self._unwatch_dir(watch, path)
+        for path in dirs - watch.dirs:
+            self._watch_dir(watch, path)
+        if mask != old_mask:
+            for path in watch.dirs:
+                self._sync_dir(path)
+
+    @staticmethod
+    def _walk(watch, root, rec):
+        exclude = dict(watch.options).get('exclude_filter')
+        if exclude and exclude(root):
+            return
+        yield root
+        if rec and os.path.isdir(root):
+            for path, dirs, _ in os.walk(root):
+                for name in tuple(dirs):
+                    subdir = os.path.join(path, name)
+                    if exclude and exclude(subdir):
+                        dirs.remove(name)
+                    else:
+                        yield subdir
+
+    def _watch_dir(self, watch, path):
+        self._dir_watches.setdefault(path, set()).add(watch)
+        watch.dirs.add(path)
+        if not self._sync_dir(path):
+            watch.dirs.discard(path)
+            self._dir_watches[path].discard(watch)
+
+    def _unwatch_dir(self, watch, path):
+        watch.dirs.discard(path)
+        self._dir_watches.get(path, set()).discard(watch)
+        self._sync_dir(path)
+
+    def _sync_dir(self, path):
+        """ Update the kernel watch on path; returns False if it failed """
+        mask = 0
+        for watch in self._dir_watches.get(path, ()):
+            mask |= watch.mask
+        fd = self._inotify.fileno()
+        if not mask:
+            self._dir_watches.pop(path, None)
+            wd = self._wds.pop(path, None)
+            if wd is not None:
+                del self._paths[wd]
+                try:
+                    inotify.rm_watch(fd, wd)
+                except OSError:
+                    pass
+            return True
         try:
-            subscriber, subscription = self.watches[event.wd]
-            subscriber.handle_updates({subscription: event}, self)
-        except:
-            pass
+            wd = inotify.add_watch(fd, path, mask)
+        except OSError:
+            if path not in self._wds:
+                return False
+            self._drop_dir(path)
+            return False
+        old = self._wds.get(path)
+        if old != wd:
+            if old is not None:
+                self._paths.pop(old, None)
+            # A different path for the same inode (e.g. a hard link or a
+            # renamed directory) replaces the old one.
+            other = self._paths.get(wd)
+            if other is not None:
+                del self._wds[other]
+            self._wds[path] = wd
+            self._paths[wd] = path
+        return True
+
+    def _drop_dir(self, path):
+        wd = self._wds.pop(path, None)
+        if wd is not None:
+            self._paths.pop(wd, None)
+        for watch in self._dir_watches.pop(path, ()):
+            watch.dirs.discard(path)
+
+    def handle_updates(self, updates, source):
+        try:
+            chunk = updates[RawFile(self._inotify)]
+        except KeyError:
+            return
+        batch = {}
+        for event in inotify.parse(chunk, self._paths):
+            if event.mask & inotify.IN_Q_OVERFLOW:
+                for watch in self._watches.values():
+                    for subscription in watch.subscriptions:
+                        batch.setdefault(subscription, []).append(event)
+                continue
+            path = event.path
+            if path is None:
+                continue
+            watches = tuple(self._dir_watches.get(path, ()))
+            if event.mask & inotify.IN_IGNORED:
+                self._drop_dir(path)
+                for watch in watches:
+                    for subscription in watch.subscriptions:
+                        batch.setdefault(subscription, []).append(event)
+                continue
+            for watch in watches:
+                for subscription in watch.subscriptions:
+                    if watch.wants(subscription, path, event):
+                        batch.setdefault(subscription, []).append(event)
+            if event.mask & inotify.IN_ISDIR \
+                    and event.mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                # Watch new directories under recursive and auto_add
+                # watches (and whatever they already contain).
+                for watch in watches:
+                    if watch.auto_add:
+                        for subdir in self._walk(watch, event.pathname, True):
+                            self._watch_dir(watch, subdir)
+        if batch:
+            self.push_updates(batch)
+
+    @manager.queued
+    def call_when_watching(self, fn, *args):
+        """
+        Call fn(*args) once the watches for the subscriptions made before
+        this call are in place.
+        """
+        fn(*args)
+
+    def push_updates(self, updates):
+        super().push_updates(updates)
+        # Events aren't state; don't replay them to new subscribers.
+        self.published_data.clear()
 
 class ScheduleEntry:
-    def __init__(self, subscriber, early, late):
-        self.subscriber = subscriber
+    def __init__(self, subscription, early, late):
+        self.subscription = subscription
         self.early = early
-        self.late = late
-        self.last = 0
-
-    def __hash__(self):
-        return hash((self.subscriber, self.early, self.late))
+        self.late = max(early, late)
+        # Bumped whenever the entry is rescheduled or removed; heap items
+        # carrying an older version are stale.
+        self.version = 0
+
+class TimerHandle:
+    """ A pending TimerSource.call_later() call """
+    def __init__(self, source, fn, args):
+        self.source = source
+        self.fn = fn
+        self.args = args
+        self.version = 0
+
+    def cancel(self):
+        self.source._cancel(self)
+
+    def reschedule(self, delay, slack=0):
+        """
+        Move the call to delay seconds from now. Returns False (and does
+        nothing) if it already fired or was cancelled.
+        """
+        return self.source._reschedule(self, delay, slack)
 
 class TimerSource(ThreadedSource):
+    """
+    Publishes the current time for (early, late) subscriptions at least
+    early and at most late seconds apart.
+
+    Entries are kept in two heaps keyed on the start and end of their next
+    window. The source sleeps until the earliest window closes and then
+    fires every entry whose window is open, so entries with loose,
+    overlapping windows share wakeups.
+
+    call_later() schedules one-off calls on the same heaps; they are queued
+    on the manager when they fire.
+    """
+    subscription_types = (tuple,)
 
     def __init__(self):
         self._interrupt_event = Event()
-        self._queue = set()
+        self._lock = Lock()
+        self._entries = {}
+        self._pending = set()
+        self._early = []
+        self._late = []
+        self._seq = 0
         super().__init__()
 
+    def _schedule(self, entry, early, late):
+        entry.version += 1
+        self._seq += 1
+        heapq.heappush(self._early, (early, self._seq, entry.version, entry))
+        heapq.heappush(self._late, (late, self._seq, entry.version, entry))
+
+    def _compact(self):
+        # Drop stale heap items once they outnumber live ones.
+        if len(self._early) > 2*(len(self._entries) + len(self._pending)) + 16:
+            for name in ("_early", "_late"):
+                heap = [i for i in getattr(self, name) if i[2] == i[3].version]
+                heapq.heapify(heap)
+                setattr(self, name, heap)
+
+    def _due(self, now):
+        fired = []
+        with self._lock:
+            while self._early and self._early[0][0] <= now:
+                _, _, version, entry = heapq.heappop(self._early)
+                if version == entry.version:
+                    fired.append(entry)
+            for entry in fired:
+                if isinstance(entry, TimerHandle):
+                    self._pending.discard(entry)
+                else:
+                    self._schedule(entry, now + entry.early, now + entry.late)
+            while self._late and self._late[0][2] != self._late[0][3].version:
+                heapq.heappop(self._late)
+            deadline = self._late[0][0] if self._late else None
+        return fired, deadline
+
     def run(self):
-        while self.running:
-            max_delay = None
-            ctime = time.time()
+        # Bail if stopped and restarted before this thread noticed.
+        while self.running and self._thread is current_thread():
+            fired, deadline = self._due(time.monotonic())
             updates = {}
             ctime = time.time()
-            for sched in self._queue:
-                if (ctime - sched.last) > sched.early:
-                    sched.last = ctime
-                    updates[(sched.early, sched.late)] = ctime
-
-                    new_max_delay = ctime + sched.late
-                    if max_delay is None or new_max_delay < max_delay:
-                        max_delay = new_max_delay
+            for entry in fired:
+                if isinstance(entry, TimerHandle):
+                    manager.queue(entry.fn, entry.args)
+                else:
+                    updates[entry.subscription] = ctime
             if updates:
                 self.push_updates(updates)
 
-            if self._interrupt_event.wait(max_delay and int(max_delay - time.time())):
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            if self._interrupt_event.wait(timeout):
                 # Reenter the queue if something is added
                 # I don't care about the actual status
                 self._interrupt_event.clear()
 
     def on_stop(self):
+        with self._lock:
+            for handle in self._pending:
+                handle.version += 1
+            self._pending.clear()
+        self._interrupt_event.set()
+
+    def _stop_if_unused(self, subscribes):
+        if not self._pending:
+            super()._stop_if_unused(subscribes)
+
+    def call_later(self, delay, fn, *args, slack=0):
+        """
+        Queue fn(*args) on the manager after delay seconds (or up to slack
+        seconds later, to share a wakeup with other timers). Returns a
+        TimerHandle that can be cancelled.
+        """
+        handle = TimerHandle(self, fn, args)
+        with self._lock:
+            self._pending.add(handle)
+            now = time.monotonic()
+            self._schedule(handle, now + delay, now + delay + slack)
+        self.start()
+        self._interrupt_event.set()
+        return handle
+
+    def _cancel(self, handle):
+        with self._lock:
+            if handle not in self._pending:
+                return
+            self._pending.discard(handle)
+            handle.version += 1
+            self._compact()
+            idle = not self._pending
+        if idle:
+            self._queue_stop_check()
+
+    def _reschedule(self, handle, delay, slack):
+        with self._lock:
+            if handle not in self._pending:
+                return False
+            now = time.monotonic()
+            self._schedule(handle, now + delay, now + delay + slack)
+            self._compact()
         self._interrupt_event.set()
+        return True
 
     def on_subscribe(self, subscriber, subscription):
-        self._queue.add(ScheduleEntry(subscriber, *subscription))
+        with self._lock:
+            if subscription in self._entries:
+                return
+            entry = self._entries[subscription] = ScheduleEntry(subscription, *subscription)
+            # Fire right away, then every (early, late) seconds.
+            now = time.monotonic()
+            self._schedule(entry, now, now)
         self._interrupt_event.set()
 
     def on_unsubscribe(self, subscriber, subscription):
-        self._queue.remove(ScheduleEntry(subscriber, *subscription))
+        if subscription in self.subscribers:
+            return
+        with self._lock:
+            entry = self._entries.pop(subscription, None)
+            if entry is not None:
+                entry.version += 1
+                self._compact()
 
     def is_publishing(self, subscription):
         try:
-            return isinstance(subscription[0], int) and isinstance(subscription[1], int)
+            return isinstance(subscription[0], (int, float)) \
+                    and isinstance(subscription[1], (int, float))
         except:
             return False
 
@@ -236,9 +968,21 @@ def get_fdsource():
         fdsource = FDManagerSource()
     return fdsource
 
+childsource = None
+def get_childsource():
+    global childsource
+    if not childsource:
+        childsource = ChildSource()
+    return childsource
+
 fwsource = None
 def get_fwsource():
     global fwsource
     if not fwsource:
         fwsource = FWManagerSource()
     return fwsource
+
+def _after_fork():
+    """ Forget the shared sources in a forked child; their threads are gone """
+    global timersource, fdsource, childsource, fwsource
+    timersource = fdsource = childsource = fwsource = None
@@ -0,0 +1,191 @@
+##
+#    This file is part of Overkill.
+#
+#    Overkill is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Overkill is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Overkill.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""
+Persist what sources publish across restarts (see Manager.enable_state).
+
+Only publishers that set persist_state take part. Published values are
+remembered per publisher (see Publisher.state_key); if two live publishers
+have the same key, only the first one to use it is persisted. Values are
+appended to a log every interval seconds; only what changed since the
+last append is written. Records are checksummed, so a torn write at the
+end is ignored on the next load. Once the log has grown well past the
+live data, it is rewritten (to a temporary file, then renamed) with just
+the latest values.
+
+Restored values are delivered on subscription like any other cached
+value, and reported by Publisher.is_stale() until the source publishes
+them again. Values that can't be pickled are not persisted.
+"""
+
+import os
+import pickle
+import struct
+import sys
+import weakref
+import zlib
+from threading import Lock
+from .sources import get_timersource
+from .util import dumps_picklable
+
+__all__ = ("StateStore",)
+
+_record = struct.Struct("!II")
+
+class StateStore:
+    # Rewrite the log once it's this much larger than the live data (and
+    # at least compact_size bytes).
+    compact_ratio = 4
+    compact_size = 1 << 20
+
+    def __init__(self, path, interval=10):
+        self.path = path
+        self.interval = interval
+        self._lock = Lock()
+        # state key -> {subscription: value}
+        self._data = {}
+        self._dirty = {}
+        # state key -> the publisher using it
+        self._owners = weakref.WeakValueDictionary()
+        self._timer = None
+        size = self._load()
+        # Superseded records don't count.
+        self._live_size = _record.size + len(self._dumps(self._data)) if self._data else 0
+        os.makedirs(os.path.dirname(path) or os.curdir, exist_ok=True)
+        self._file = open(path, "ab")
+        # Drop a torn record so that appends stay readable.
+        self._file.truncate(size)
+        self._log_size = size
+
+    def _load(self):
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return 0
+        offset = 0
+        while len(data) - offset >= _record.size:
+            length, checksum = _record.unpack_from(data, offset)
+            start = offset + _record.size
+            payload = data[start:start + length]
+            if len(payload) < length or zlib.crc32(payload) != checksum:
+                break
+            try:
+                records = pickle.loads(payload)
+            except Exception:
+                break
+            for key, values in records.items():
+                self._data.setdefault(key, {}).update(values)
+            offset = start + length
+        return offset
+
+    def restore(self, publisher):
+        """ Preload publisher's published_data with what was saved (once) """
+        if publisher._restored:
+            return
+        publisher._restored = True
+        with self._lock:
+            if not self._claim(publisher):
+                return
+            saved = self._data.get(publisher.state_key)
+            if not saved:
+                return
+            published = publisher.published_data
+            for subscription, value in saved.items():
+                if subscription not in published:
+                    published[subscription] = value
+                    publisher._stale.add(subscription)
+
+    def _claim(self, publisher):
+        key = publisher.state_key
+        owner = self._owners.setdefault(key, publisher)
+        if owner is publisher:
+            return True
+        if not getattr(publisher, "_state_conflict", False):
+            publisher._state_conflict = True
+            sys.stderr.write(
+                "overkill: %r and %r share the state key %r; not persisting the latter\n"
+                % (owner, publisher, key)
+            )
+        return False
+
+    def record(self, publisher, updates):
+        with self._lock:
+            if not self._claim(publisher):
+                return
+            try:
+                self._dirty[publisher.state_key].update(updates)
+            except KeyError:
+                self._dirty[publisher.state_key] = dict(updates)
+            if self._timer is None and self.interval is not None:
+                self._timer = get_timersource().call_later(
+                    self.interval, StateStore.flush, self, slack=self.interval/2
+                )
+
+    def flush(self):
+        """ Append what changed since the last flush to the log """
+        with self._lock:
+            self._timer = None
+            dirty, self._dirty = self._dirty, {}
+            if not dirty or self._file is None:
+                return
+            payload = self._dumps(dirty)
+            for key, values in dirty.items():
+                self._data.setdefault(key, {}).update(values)
+            self._append(self._file, payload)
+            self._file.flush()
+            self._log_size += _record.size + len(payload)
+            if self._log_size > max(self.compact_size, self.compact_ratio*self._live_size):
+                self._compact()
+
+    @staticmethod
+    def _dumps(records):
+        return dumps_picklable(records, StateStore._prune)
+
+    @staticmethod
+    def _prune(records, picklable):
+        return {
+            key: {s: v for s, v in values.items() if picklable((s, v))}
+            for key, values in records.items()
+        }
+
+    @staticmethod
+    def _append(f, payload):
+        f.write(_record.pack(len(payload), zlib.crc32(payload)))
+        f.write(payload)
+
+    def _compact(self):
+        payload = self._dumps(self._data)
+        tmp = "%s.%d" % (self.path, os.getpid())
+        with open(tmp, "wb") as f:
+            self._append(f, payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self._file.close()
+        self._file = open(self.path, "ab")
+        self._live_size = self._log_size = _record.size + len(payload)
+
+    def close(self):
+        """ Flush and stop persisting """
+        if self._timer is not None:
+            self._timer.cancel()
+        self.flush()
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
@@ -0,0 +1,53 @@
+##
+#    This file is part of Overkill.
+#
+#    Overkill is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    Overkill is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Overkill.  If not, see <http://www.gnu.org/licenses/>.
+##
+
+"""
+Helpers shared by the manager, the daemon and the modules built on them.
+"""
+
+import os
+import pickle
+
+__all__ = ("xdg_home", "dumps_picklable")
+
+def xdg_home(variable, default):
+    """ The XDG base directory named by variable, or ~/default """
+    return os.environ.get(variable) or os.path.join(os.path.expanduser("~"), default)
+
+def _pickle_dumps(obj):
+    return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+def dumps_picklable(obj, prune, dumps=_pickle_dumps, report=False):
+    """
+    Pickle obj with dumps. If that fails, pickle prune(obj, picklable)
+    instead, where picklable(value) tells whether dumps can pickle value,
+    so that one bad value doesn't lose the rest. With report, the failure
+    is printed first.
+    """
+    try:
+        return dumps(obj)
+    except Exception:
+        if report:
+            import traceback
+            traceback.print_exc()
+    def picklable(value):
+        try:
+            dumps(value)
+        except Exception:
+            return False
+        return True
+    return dumps(prune(obj, picklable))
@@ -20,8 +20,6 @@ setup(
     name = "overkill",
     version = "0.1",
     packages = find_packages(),
-    namespace_packages = ["overkill", "overkill.extra"],
-    install_requires = ["pyinotify"],
     author = "Steven Allen",
     author_email = "steven@stebalien.com",
     description = "A local pub-sub framework",